@@ -2,6 +2,8 @@ import logging
 from google.cloud import bigquery
 from datetime import datetime
 import numpy as np
+import pandas as pd
+import pyarrow as pa
 
 from utils.io import json_to_dict
 
@@ -85,16 +87,143 @@ def bigquery_dtypes_to_python(bq_dtype: str) -> str:
     return lookup[bq_dtype]
 
 
-def get_source_format(file_type):
-    """
-    get bigquery source format from file type
-    @param file_type (e.g. csv or json)
-    """
+def bigquery_dtypes_to_arrow(bq_dtype: str) -> pa.DataType:
     lookup = {
-        'csv': 'CSV',
-        'json': bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        'STRING': pa.string(),
+        'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+        'DATETIME': pa.timestamp('us'),
+        'DATE': pa.date32(),
+        'INTEGER': pa.int64(),
+        'INT64': pa.int64(),
+        'FLOAT': pa.float64(),
+        'FLOAT64': pa.float64(),
+        'BOOLEAN': pa.bool_(),
+        'BOOL': pa.bool_(),
     }
-    return lookup[file_type]
+    return lookup.get(bq_dtype)
+
+
+def datetime_series_to_type(series: pd.Series, arrow_type: pa.DataType) -> pd.Series:
+    """
+    Convert a datetime column loaded into a non temporal bigquery type, timestamps are formatted for strings
+    and converted to unix time for numbers (microseconds for integers, seconds for floats)
+    @param series pandas datetime series
+    @param arrow_type target arrow type
+    @return converted series
+    """
+    if pa.types.is_string(arrow_type):
+        return series.dt.strftime('%Y-%m-%d %H:%M:%S.%f%z')
+    if series.dt.tz is not None:
+        series = series.dt.tz_convert(None)
+    if pa.types.is_integer(arrow_type):
+        return ((series - pd.Timestamp(0)) // pd.Timedelta(microseconds=1)).astype('Int64')
+    if pa.types.is_floating(arrow_type):
+        return (series - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+    raise TypeError(f'Cannot load datetime column {series.name} as {arrow_type}')
+
+
+def dataframe_to_arrow(dataframe: pd.DataFrame, schema: list = None) -> pa.Table:
+    """
+    Convert dataframe to an arrow table typed with a bigquery schema, columns without a schema type are inferred
+    @param dataframe pandas dataframe
+    @param schema list of bigquery.SchemaField
+    @return arrow table
+    """
+    types = {field.name: bigquery_dtypes_to_arrow(field.field_type) for field in (schema or [])}
+    arrays, names = [], []
+    for name in dataframe.columns:
+        series = dataframe[name]
+        arrow_type = types.get(name)
+        if arrow_type is not None and pa.types.is_timestamp(arrow_type) and not pd.api.types.is_datetime64_any_dtype(series):
+            series = pd.to_datetime(series, utc=arrow_type.tz is not None, format='mixed')
+        elif arrow_type == pa.date32() and not pd.api.types.is_datetime64_any_dtype(series):
+            series = pd.to_datetime(series, format='mixed')
+        if arrow_type is not None and pd.api.types.is_datetime64_any_dtype(series):
+            # bigquery stores microseconds, align timezone with the target type before casting
+            if not pa.types.is_timestamp(arrow_type) and not pa.types.is_date(arrow_type):
+                series = datetime_series_to_type(series, arrow_type)
+            elif arrow_type == pa.date32():
+                series = series.dt.date
+            elif arrow_type.tz is None and series.dt.tz is not None:
+                series = series.dt.tz_convert(None)
+            elif arrow_type.tz is not None and series.dt.tz is None:
+                series = series.dt.tz_localize('UTC')
+            if pa.types.is_timestamp(arrow_type):
+                series = series.dt.floor('us')
+        # safe casts raise on truncation and overflow (e.g. 2.7 or 2**63 into INTEGER) instead of corrupting data
+        arrays.append(pa.array(series, type=arrow_type, from_pandas=True) if arrow_type is not None
+                      else pa.array(series, from_pandas=True))
+        names.append(str(name))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def get_range_partitions(values, partition_range: dict, window: int = None) -> list:
+    """
+    Get the integer range partitions present in a column, highest first
+    @param values pandas series of partition column values
+    @param partition_range dict with start, end and interval of the integer partitions
+    @param window if set, number of partitions to return
+    @return list of tuples containing start (inclusive) and end (exclusive) of each partition
+    """
+    start, end, interval = partition_range['start'], partition_range['end'], partition_range['interval']
+    values = values.dropna()
+    in_range = values[(values >= start) & (values < end)].astype('int64')
+    if len(in_range) < len(values):
+        logging.warning(f'{len(values) - len(in_range)} rows outside partition range [{start}, {end}) are not uploaded in window mode')
+    starts = np.unique(start + ((in_range - start) // interval) * interval)[::-1]
+    if window is not None:
+        starts = starts[:window]
+    return [(int(x), int(min(x + interval, end))) for x in starts]
+
+
+def set_table_options(job_config: bigquery.LoadJobConfig,
+                      partition_col: str = None,
+                      partition_type: str = None,
+                      partition_range: dict = None,
+                      partition_expiration_days: int = None,
+                      clustering_fields: list = None
+                      ) -> bigquery.LoadJobConfig:
+    """
+    Set partitioning and clustering on a load job config, these define the table when the load creates it
+    @param job_config load job config to update
+    @param partition_col name of partition column
+    @param partition_type DAY, MONTH, YEAR or RANGE
+    @param partition_range if partition_type is RANGE, dict with start, end and interval
+    @param partition_expiration_days number of days to keep time partitions
+    @param clustering_fields list of up to four columns to cluster by
+    @return updated job config
+    """
+    if partition_col is not None:
+        if partition_type == 'RANGE':
+            job_config.range_partitioning = bigquery.RangePartitioning(
+                field=partition_col,
+                range_=bigquery.PartitionRange(**partition_range),
+            )
+            if partition_expiration_days is not None:
+                logging.warning('partition_expiration_days only applies to time partitioned tables, ignoring')
+        else:
+            job_config.time_partitioning = bigquery.TimePartitioning(
+                type_=get_partition_type_from_str(partition_type),
+                field=partition_col,  # Name of the column to use for partitioning.
+                expiration_ms=partition_expiration_days * 86400000 if partition_expiration_days is not None else None,
+            )
+    if clustering_fields is not None:
+        job_config.clustering_fields = list(clustering_fields)
+    return job_config
+
+
+def build_table(table_ref: bigquery.table.TableReference, job_config: bigquery.LoadJobConfig) -> bigquery.Table:
+    """
+    Build a bigquery table definition with the schema, partitioning and clustering of a load job config
+    @param table_ref reference of the table to create
+    @param job_config load job config with schema and table options
+    @return bigquery table object
+    """
+    table = bigquery.Table(table_ref, schema=job_config.schema)
+    table.time_partitioning = job_config.time_partitioning
+    table.range_partitioning = job_config.range_partitioning
+    table.clustering_fields = job_config.clustering_fields
+    return table
 
 
 # Helpers
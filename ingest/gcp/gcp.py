@@ -5,8 +5,10 @@ from google.api_core.exceptions import NotFound
 from pathlib import Path
 from datetime import datetime, timedelta
 
-from .migrate import upload_dataframe_to_table, upload_bucket_to_table, upload_dataframe_to_bucket
-from .bigquery import get_partition_type_from_str, get_partition_range, get_partition_format_from_str, get_source_format, table_schema_to_json
+from .migrate import upload_dataframe_to_table, upload_bucket_to_table, upload_dataframe_to_bucket, upload_dataframe_to_bucket_sharded
+from .validate import validate_dataframe, conform_columns
+from .bigquery import get_partition_range, get_partition_format_from_str, get_source_format, table_schema_to_json, \
+    get_range_partitions, set_table_options, build_table
 
 
 class GcpConnector:
@@ -20,6 +22,7 @@ class GcpConnector:
             downloads_path = str(Path.home() / "Downloads")
             key_path = f'{downloads_path}/{auth_config["key_file"]}'
             credentials = self.__auth_with_service_key(key_path)
+            self.credentials = credentials
             self.billing_project = credentials.project_id
 
             # Construct a BigQuery client object.
@@ -30,10 +33,14 @@ class GcpConnector:
                 credentials=credentials, project=credentials.project_id
             )
         else:
+            self.credentials = None # application default credentials
+
             # Construct a BigQuery client object.
             self.bq_client = bigquery.Client()      
             self.storage_client = storage.Client()      
 
+        self.validation_reports = []
+
 
     def __auth_with_service_key(self, key_path: str) -> service_account.Credentials:
         # Retrieve service account
@@ -42,17 +49,48 @@ class GcpConnector:
             scopes=["https://www.googleapis.com/auth/cloud-platform"],
         )
         return credentials
+
+
+    def __validate(self, dataframe, schema_path, table_id, partition_col, quarantine, bucketname, blobdir, file_type):
+        """Validate dataframe against schema before upload, quarantining invalid rows to the bucket if configured"""
+        valid, invalid, report = validate_dataframe(dataframe, schema_path, table_id, partition_col, file_type)
+        self.validation_reports.append(report)
+        if report['missing_columns'] or report['unexpected_columns']:
+            raise ValueError(f"Dataframe {table_id} does not match {schema_path}, missing required columns: "
+                             f"{report['missing_columns']}, unexpected columns: {report['unexpected_columns']}")
+        if report['invalid_rows'] == 0:
+            return valid
+        if not quarantine or bucketname is None:
+            raise ValueError(f"{report['invalid_rows']} invalid rows in {table_id}: {report['errors']}")
+
+        blobname = f'quarantine/{datetime.utcnow().strftime("%Y%m%d%H%M%S")}:{table_id}'
+        if blobdir is not None:
+            blobname = f"{blobdir}/{blobname}"
+        gcslocation = upload_dataframe_to_bucket(self.storage_client, invalid, bucketname, blobname, 'json')
+        logging.warning(f"Quarantined {report['invalid_rows']} invalid rows of {table_id} to {gcslocation}")
+        return valid
+
+
+    def __dataframe_to_bucket(self, storage_client, dataframe, bucketname, blobname, file_type,
+                              shard_rows=None, shard_workers=None) -> str:
+        """Upload dataframe as a single blob, or as shards if it has more than shard_rows rows"""
+        if shard_rows is not None and len(dataframe.index) > shard_rows:
+            return upload_dataframe_to_bucket_sharded(storage_client, dataframe, bucketname, blobname,
+                                                      file_type, shard_rows, shard_workers)
+        return upload_dataframe_to_bucket(storage_client, dataframe, bucketname, blobname, file_type)
     
 
     def upload_dataframe_to_table_via_bucket(self, dataframe, uploaded_at, file_type,
                                              storage_client, bucketname, blobdir,
-                                             bq_client, dataset_id, table_id, table_ref, job_config):
+                                             bq_client, dataset_id, table_id, table_ref, job_config,
+                                             shard_rows=None, shard_workers=None):
         """Upload dataframe to BigQuery table via storage bucket"""
         blobname = f'{uploaded_at.strftime("%Y%m%d")}:{table_id}'
         if blobdir is not None:
             blobname = f"{blobdir}/{blobname}"
         logging.info(f'Uploading dataframe to bucket: gs://{bucketname}/{blobname}')
-        gcslocation = upload_dataframe_to_bucket(storage_client, dataframe, bucketname, blobname, file_type)
+        gcslocation = self.__dataframe_to_bucket(storage_client, dataframe, bucketname, blobname, file_type,
+                                                 shard_rows, shard_workers)
         logging.info(f'Uploading gcsfile from {gcslocation} to bigquery table: {dataset_id}:{table_id}')
         try:
             job_config.source_format = get_source_format(file_type) 
@@ -61,13 +99,14 @@ class GcpConnector:
         upload_bucket_to_table(bq_client, gcslocation, table_ref, job_config)
 
     
-    def upload_dataframe_to_table_with_partition_via_bucket(self, dataframe, uploaded_at, file_type,
-                                             storage_client, bucketname, blobdir,
-                                             bq_client, dataset_id, table_id, dataset_ref, table_ref, job_config, 
-                                             partition_col, partition_type, lag, window):
-        """Upload dataframe to table with partition via storage bucket"""
-        try:
-            bq_client.get_table(dataset_ref.table(table_id))  # Make an API request.
+    def __partition_slices(self, dataframe, uploaded_at, partition_col, partition_type, partition_range, lag, window):
+        """Yield (partition_id, row mask) for each partition in the upload window"""
+        if partition_type == 'RANGE':
+            # Integer range partitions are identified by their start value, window counts back from the highest partition in the data
+            for start, end in get_range_partitions(dataframe[partition_col], partition_range, window):
+                logging.info(f'range: [{start}, {end})')
+                yield str(start), dataframe[partition_col].ge(start) & dataframe[partition_col].lt(end)
+        else:
             dataframe[partition_col] = dataframe[partition_col].dt.tz_localize(None)
             dt = uploaded_at - timedelta(days=lag) # Start lag days back if data lags the download date
             for _ in range(0, window):
@@ -75,31 +114,58 @@ class GcpConnector:
                 dt = start_date - timedelta(days=1) # Next date in loop
                 partition_id = start_date.strftime(get_partition_format_from_str(partition_type))
                 logging.info(f'range: ({start_date}, {end_date})')
-                blobname = f'{uploaded_at.strftime("%Y%m%d")}:{table_id}${partition_id}'
-                if blobdir is not None:
-                    blobname = f"{blobdir}/{blobname}"
-                logging.info(f'Uploading dataframe to gcslocation: gs://{bucketname}/{blobname}')
-                gcslocation = upload_dataframe_to_bucket(storage_client, 
-                                                        dataframe.loc[dataframe[partition_col].between(start_date, end_date)], 
-                                                        bucketname, 
-                                                        blobname,
-                                                        file_type)
-                table_ref = dataset_ref.table(f'{table_id}${partition_id}')
-                logging.info(f'Uploading gcsfile from {gcslocation} to bigquery table: {dataset_id}:{table_id}${partition_id}')
-                job_config.skip_leading_rows=1
-                try:
-                    job_config.source_format = get_source_format(file_type) 
-                except KeyError:
-                    return logging.warning(f'No upload method for file type {file_type}') 
-                upload_bucket_to_table(bq_client, gcslocation, table_ref, job_config)
+                yield partition_id, dataframe[partition_col].between(start_date, end_date)
+
+
+    def upload_dataframe_to_table_with_partition_via_bucket(self, dataframe, uploaded_at, file_type,
+                                             storage_client, bucketname, blobdir,
+                                             bq_client, dataset_id, table_id, dataset_ref, table_ref, job_config, 
+                                             partition_col, partition_type, lag, window,
+                                             shard_rows=None, shard_workers=None, partition_range=None):
+        """Upload dataframe to table with partition via storage bucket"""
+        try:
+            bq_client.get_table(dataset_ref.table(table_id))  # Make an API request.
         except NotFound:
-            return logging.info(f'Table {dataset_id}.{table_id} not found. Create table first to use window uploads.')    
+            if job_config.schema is None:
+                return logging.info(f'Table {dataset_id}.{table_id} not found. Create table first to use window uploads.')
+            logging.info(f'Table {dataset_id}.{table_id} not found. Creating table from upload config.')
+            bq_client.create_table(build_table(dataset_ref.table(table_id), job_config))
+
+        for partition_id, mask in self.__partition_slices(dataframe, uploaded_at, partition_col, partition_type,
+                                                          partition_range, lag, window):
+            blobname = f'{uploaded_at.strftime("%Y%m%d")}:{table_id}${partition_id}'
+            if blobdir is not None:
+                blobname = f"{blobdir}/{blobname}"
+            logging.info(f'Uploading dataframe to gcslocation: gs://{bucketname}/{blobname}')
+            gcslocation = self.__dataframe_to_bucket(storage_client, 
+                                                    dataframe.loc[mask], 
+                                                    bucketname, 
+                                                    blobname,
+                                                    file_type,
+                                                    shard_rows,
+                                                    shard_workers)
+            table_ref = dataset_ref.table(f'{table_id}${partition_id}')
+            logging.info(f'Uploading gcsfile from {gcslocation} to bigquery table: {dataset_id}:{table_id}${partition_id}')
+            job_config.skip_leading_rows=1
+            try:
+                job_config.source_format = get_source_format(file_type) 
+            except KeyError:
+                return logging.warning(f'No upload method for file type {file_type}') 
+            upload_bucket_to_table(bq_client, gcslocation, table_ref, job_config)
     
 
     def upload_dataframe_to_table_with_merge_via_bucket(self, dataframe, uploaded_at, file_type, merge_id_column,
                                                 storage_client, bucketname, blobdir,
-                                                bq_client, dataset_id, table_id, table_ref, job_config):
+                                                bq_client, dataset_id, table_id, table_ref, job_config,
+                                                shard_rows=None, shard_workers=None):
         """Upload dataframe to BigQuery table via bucket by merging dataframe to existing table using an id_column"""
+        try:
+            bq_client.get_table(table_ref)  # Make an API request.
+        except NotFound:
+            if job_config.schema is None:
+                return logging.info(f'Table {dataset_id}.{table_id} not found. Create table first to use merge uploads.')
+            logging.info(f'Table {dataset_id}.{table_id} not found. Creating table from upload config.')
+            bq_client.create_table(build_table(table_ref, job_config))
 
         staging_dataset_id = f'{dataset_id}_staging'
         staging_table_id = f'stg__{uploaded_at.strftime("%Y%m%d")}_{table_id}'
@@ -109,7 +175,8 @@ class GcpConnector:
 
         self.upload_dataframe_to_table_via_bucket(dataframe, uploaded_at, file_type,
                                              storage_client, bucketname, blobdir,
-                                             bq_client, staging_dataset_id, staging_table_id, staging_table_ref, job_config)
+                                             bq_client, staging_dataset_id, staging_table_id, staging_table_ref, job_config,
+                                             shard_rows, shard_workers)
         
         cols = [x.name for x in job_config.schema]
         cols.remove(merge_id_column)
@@ -148,7 +215,16 @@ class GcpConnector:
                keep_autodetect_table = False,
                file_type: str = 'csv',
                merge = False,
-               merge_id_column: str = None
+               merge_id_column: str = None,
+               shard_rows: int = None,
+               shard_workers: int = None,
+               partition_range: dict = None,
+               partition_expiration_days: int = None,
+               clustering_fields: list = None,
+               extract_date: datetime = None,
+               validate: bool = False,
+               quarantine: bool = False,
+               chunk_size_mb: float = 256
                ) -> None:
         """
         Upload dataframe to bigquery table. Run options include use of bucket and partitions.
@@ -159,13 +235,22 @@ class GcpConnector:
         @param bucketname if using bucket, name of bucket
         @param blobdir sub directory for gcp storage bucket
         @param partition_col if using partition, name of partition column
-        @param partition_type type of partition (DAY, MONTH, YEAR)
+        @param partition_type type of partition (DAY, MONTH, YEAR or RANGE for integer range partitions)
         @param window if using window, number of partition units to write into bq
         @param lag how many days to lag run date
         @param autodetect_mode If true, run the upload function with 100 rows of data to autodetect table schema
         @param keep_autodetect_table Do not automatically drop the table used for autodetecting table schema
         @param file_type specify file type for storage bucket (e.g. csv or json)
         @param merge if merge is true merge data into existing table, another incremental strategy
+        @param shard_rows if using bucket, split dataframes with more rows than this into shards loaded with a wildcard uri
+        @param shard_workers number of threads used to upload shards, serialisation uses a shared pool of cpu count processes
+        @param partition_range if partition_type is RANGE, dict with start, end and interval of integer partitions
+        @param partition_expiration_days number of days to keep time partitions
+        @param clustering_fields list of up to four columns to cluster the table by
+        @param extract_date if set, used instead of the upload time to name blobs and anchor windows (e.g. for backfills)
+        @param validate if true, validate dataframe against schema_path before upload and fail early on invalid data
+        @param quarantine if validating with a bucket, upload invalid rows to <blobdir>/quarantine and load the valid rows
+        @param chunk_size_mb if not using bucket, size of the parquet chunks streamed into the table
         """
 
         bq_client = self.bq_client
@@ -189,11 +274,9 @@ class GcpConnector:
 
         table_ref = dataset_ref.table(table_id)
 
-        if partition_col is not None and autodetect_mode is False:
-            job_config.time_partitioning=bigquery.TimePartitioning(
-                type_=get_partition_type_from_str(partition_type),
-                field=partition_col,  # Name of the column to use for partitioning.
-            )
+        if autodetect_mode is False:
+            set_table_options(job_config, partition_col, partition_type, partition_range,
+                              partition_expiration_days, clustering_fields)
 
         if schema_path is None or autodetect_mode:
             job_config.autodetect=True
@@ -202,6 +285,13 @@ class GcpConnector:
             job_config.schema = schema
             if file_type == 'csv':
                 job_config.skip_leading_rows=1
+            if validate:
+                dataframe = self.__validate(dataframe, schema_path, table_id,
+                                            partition_col if partition_type != 'RANGE' else None,
+                                            quarantine, bucketname, blobdir, file_type)
+            elif file_type == 'csv':
+                # csv is loaded by column position, so columns must follow the schema order
+                dataframe = conform_columns(dataframe, [x.name for x in schema])
 
         # No accepted way to do this without adding to payload at time of writing: https://issuetracker.google.com/issues/72080883?pli=1
         uploaded_at = datetime.utcnow()
@@ -209,6 +299,10 @@ class GcpConnector:
         if add_updated_at:
             dataframe.insert(0, '_etl_loaded_at', uploaded_at)
 
+        # Backfills name blobs, staging tables and windows after the extract date so concurrent runs do not collide
+        if extract_date is not None:
+            uploaded_at = extract_date
+
         logging.info(job_config)
 
         # don't allow config with a window on autodetect mode
@@ -216,23 +310,26 @@ class GcpConnector:
             self.upload_dataframe_to_table_with_partition_via_bucket(dataframe, uploaded_at, file_type,
                                              storage_client, bucketname, blobdir,
                                              bq_client, dataset_id, table_id, dataset_ref, table_ref, job_config, 
-                                             partition_col, partition_type, lag, window)
+                                             partition_col, partition_type, lag, window,
+                                             shard_rows, shard_workers, partition_range)
         
         elif ((use_bucket == True) & (merge == True) & (autodetect_mode is False)):
             self.upload_dataframe_to_table_with_merge_via_bucket(
                                                 dataframe=dataframe, uploaded_at=uploaded_at, file_type=file_type, merge_id_column=merge_id_column,
                                                 storage_client=storage_client, bucketname=bucketname, blobdir=blobdir,
-                                                bq_client=bq_client, dataset_id=dataset_id, table_id=table_id, table_ref=table_ref, job_config=job_config)
+                                                bq_client=bq_client, dataset_id=dataset_id, table_id=table_id, table_ref=table_ref, job_config=job_config,
+                                                shard_rows=shard_rows, shard_workers=shard_workers)
 
         # upload directly to bq and overwrite table
         elif (use_bucket == False):
-            self.upload_dataframe_to_table(bq_client, dataframe, table_ref, job_config)
+            upload_dataframe_to_table(bq_client, dataframe, table_ref, job_config, chunk_size_mb)
         
         # upload to bq via bucket and overwrite whole table
         elif ((use_bucket == True) & (window is None or autodetect_mode)):
             self.upload_dataframe_to_table_via_bucket(dataframe, uploaded_at, file_type,
                                              storage_client, bucketname, blobdir,
-                                             bq_client, dataset_id, table_id, table_ref, job_config)
+                                             bq_client, dataset_id, table_id, table_ref, job_config,
+                                             shard_rows, shard_workers)
         
         else:
             return logging.exception('No option for configuration setup')
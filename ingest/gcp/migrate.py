@@ -1,32 +1,95 @@
+import io
+import os
+import re
 import logging
+import math
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from google.cloud import bigquery, storage
 from google.cloud.storage import Blob
 import pandas as pd
+import pyarrow.parquet as pq
+
+from .bigquery import dataframe_to_arrow
+
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'json': 'text/json',
+}
+
+
+_serialise_pool = None # shared process pool, see get_serialise_pool
+_serialise_pool_lock = threading.Lock()
+
+
+def get_serialise_pool() -> ProcessPoolExecutor:
+    """
+    Shared process pool for serialising shards, bounded to the cpu count however many uploads run concurrently.
+    Workers are started with forkserver (spawn where unavailable), forking a process with live threads can deadlock.
+    """
+    global _serialise_pool
+    with _serialise_pool_lock:
+        if _serialise_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _serialise_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(method))
+        return _serialise_pool
+
+
+def iter_dataframe_chunks(dataframe: pd.DataFrame, chunk_size_mb: float = 256):
+    """
+    Split dataframe into row slices of roughly chunk_size_mb in memory
+    @param dataframe pandas dataframe
+    @param chunk_size_mb target size of each chunk
+    """
+    nrow = len(dataframe.index)
+    if nrow == 0:
+        yield dataframe
+        return
+    row_bytes = max(1, dataframe.memory_usage(index=False, deep=True).sum() / nrow)
+    chunk_rows = max(1, int(chunk_size_mb * 1024 ** 2 / row_bytes))
+    for start in range(0, nrow, chunk_rows):
+        yield dataframe.iloc[start:start + chunk_rows]
 
 
 def upload_dataframe_to_table(
     bq_client,
-    dataframe: pd.DataFrame,
+    dataframe,
     table_ref: str,
     job_config: bigquery.LoadJobConfig,
-) -> None:
+    chunk_size_mb: float = 256,
+) -> int:
     """
-    Upload pandas dataframe to BigQuery table
+    Upload pandas dataframe to BigQuery table without a bucket. Data is converted to arrow typed with the job schema
+    and streamed as parquet chunks of bounded size, the first chunk uses the job write disposition and the rest append.
     @param bq_client bigquery client object
-    @param dataframe pandas dataframe
+    @param dataframe pandas dataframe, or an iterable of dataframes for data larger than memory
     @param table_ref full reference of bigquery table project.dataset.table
     @param job_config configuration for upload
+    @param chunk_size_mb target size of each chunk loaded, when dataframe is a single dataframe
+    @return number of rows loaded, from the load job statistics
     """
-    job = bq_client.load_table_from_dataframe(
-        dataframe, table_ref, job_config=job_config
-    )
-    job.result()
-    table = bq_client.get_table(table_ref)
-    logging.info(
-        "Loaded {} rows and {} columns to {}".format(
-            table.num_rows, len(table.schema), table_ref
-        )
-    )
+    chunks = iter_dataframe_chunks(dataframe, chunk_size_mb) if isinstance(dataframe, pd.DataFrame) else dataframe
+    output_rows = 0
+    for i, chunk in enumerate(chunks):
+        buffer = io.BytesIO()
+        pq.write_table(dataframe_to_arrow(chunk, job_config.schema), buffer,
+                       coerce_timestamps='us', allow_truncated_timestamps=True)
+        buffer.seek(0)
+
+        chunk_config = bigquery.LoadJobConfig.from_api_repr(job_config.to_api_repr())
+        chunk_config.source_format = bigquery.SourceFormat.PARQUET
+        if i > 0:
+            chunk_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+
+        job = bq_client.load_table_from_file(buffer, table_ref, job_config=chunk_config, rewind=True)
+        job.result()
+        output_rows += job.output_rows or 0
+        logging.info(f'Loaded chunk {i} ({job.output_rows} rows) to {table_ref}')
+
+    logging.info(f"Loaded {output_rows} rows to {table_ref}")
+    return output_rows
 
 
 def upload_dataframe_to_bucket(
@@ -41,17 +104,83 @@ def upload_dataframe_to_bucket(
     """
     bucket = storage_client.get_bucket(bucketname)
     blob = Blob(blobname, bucket)
-    if file_type == 'csv':
-        blob.upload_from_string(dataframe.to_csv(index=False, date_format='%Y-%m-%d %H:%M:%S'), 'text/csv')
-    elif file_type == 'json':
-        # Must be new line deliminated json for bigquery: https://stackoverflow.com/questions/28976546/write-pandas-dataframe-to-newline-delimited-json
-        blob.upload_from_string(dataframe.to_json(orient='records', lines=True, date_format='iso'), 'text/json')  
+    if file_type in CONTENT_TYPES:
+        blob.upload_from_string(serialise_dataframe(dataframe, file_type), CONTENT_TYPES[file_type])
     else:
         logging.info(f'No upload method for file type {file_type}')
 
     return 'gs://{}/{}'.format(bucketname, blobname)
 
 
+def serialise_dataframe(dataframe: pd.DataFrame, file_type: str = 'csv') -> str:
+    """
+    Serialise dataframe to a string in a format bigquery can load
+    @param dataframe pandas dataframe
+    @param file_type csv or json
+    @return serialised dataframe
+    """
+    if file_type == 'csv':
+        return dataframe.to_csv(index=False, date_format='%Y-%m-%d %H:%M:%S')
+    elif file_type == 'json':
+        # Must be new line deliminated json for bigquery: https://stackoverflow.com/questions/28976546/write-pandas-dataframe-to-newline-delimited-json
+        return dataframe.to_json(orient='records', lines=True, date_format='iso')
+    raise KeyError(file_type)
+
+
+def upload_dataframe_to_bucket_sharded(
+        storage_client,
+        dataframe: pd.DataFrame,
+        bucketname: str,
+        blobname: str,
+        file_type: str = 'csv',
+        shard_rows: int = 1_000_000,
+        max_workers: int = None
+    ) -> str:
+    """
+    Split dataframe into row shards, serialise them in the shared process pool and upload them concurrently
+    as blobname-00000.ext, blobname-00001.ext, ...
+    @param storage_client storage client object
+    @param dataframe pandas dataframe
+    @param bucketname name of storage bucket
+    @param blobname prefix of the shard blobs
+    @param file_type csv or json
+    @param shard_rows maximum number of rows per shard
+    @param max_workers number of threads used to upload, serialisation is bounded by the shared process pool
+    @return wildcard uri matching all shards, for a single bigquery load job
+    """
+    if file_type not in CONTENT_TYPES:
+        raise KeyError(file_type)
+
+    bucket = storage_client.get_bucket(bucketname)
+
+    # remove shards of an earlier upload to the same prefix, otherwise the wildcard load would pick them up
+    shard_pattern = re.compile(rf'{re.escape(blobname)}-\d{{5}}\.{re.escape(file_type)}')
+    stale = [x for x in storage_client.list_blobs(bucketname, prefix=f'{blobname}-') if shard_pattern.fullmatch(x.name)]
+    if stale:
+        logging.info(f'Deleting {len(stale)} stale shards of gs://{bucketname}/{blobname}')
+        for blob in stale:
+            blob.delete()
+
+    n_shards = max(1, math.ceil(len(dataframe.index) / shard_rows))
+    shards = [dataframe.iloc[i * shard_rows:(i + 1) * shard_rows] for i in range(n_shards)]
+    logging.info(f'Serialising {len(dataframe.index)} rows into {n_shards} shards of up to {shard_rows} rows')
+
+    def upload_shard(args):
+        index, payload = args
+        blob = Blob(f'{blobname}-{index:05d}.{file_type}', bucket)
+        blob.upload_from_string(payload, CONTENT_TYPES[file_type])
+
+    # pandas serialisation holds the GIL so use processes, uploads are io bound so use threads
+    with ThreadPoolExecutor(max_workers=max_workers) as thread_pool:
+        payloads = get_serialise_pool().map(serialise_dataframe, shards, [file_type] * n_shards)
+        # consume lazily, so uploads start as soon as each shard is serialised
+        uploads = [thread_pool.submit(upload_shard, item) for item in enumerate(payloads)]
+        for upload in uploads:
+            upload.result()
+
+    return 'gs://{}/{}-*.{}'.format(bucketname, blobname, file_type)
+
+
 def upload_bucket_to_table(
     bq_client: bigquery.Client,
     gcsfile: str,
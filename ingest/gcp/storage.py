@@ -1,17 +1,210 @@
+import os
+import math
+import base64
+import logging
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import google_crc32c
 from google.cloud import storage
 
 
-def upload_file_to_bucket(src_filename, src_dir, bucket, blobname):
-    client = storage.Client()
+MAX_COMPOSE_SOURCES = 32 # limit of gcs compose requests
 
-    bucket = client.get_bucket(bucket)
-    blob = bucket.blob(blobname)
-    blob.upload_from_filename(f'{src_dir}/{src_filename}')
 
+@lru_cache(maxsize=None)
+def get_storage_client() -> storage.Client:
+    """Shared default storage client, so bulk transfers do not create a client per file"""
+    return storage.Client()
 
-def download_file_from_bucket(bucketname, blobname, destination_file_name):
 
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucketname)
-    blob = bucket.blob(blobname)
-    blob.download_to_filename(destination_file_name)
\ No newline at end of file
+def file_crc32c(filename: str, chunk_size: int = 8 * 1024 ** 2) -> str:
+    """
+    Compute base64 encoded crc32c of a local file, the format gcs reports for blob.crc32c
+    @param filename path of local file
+    @return base64 encoded checksum
+    """
+    checksum = google_crc32c.Checksum()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+def _composite_upload(bucket, filename: str, blobname: str, size: int, chunk_size: int, max_workers: int) -> None:
+    """Upload file as parallel parts, compose them into one blob and delete the parts"""
+    chunk_size = max(chunk_size, math.ceil(size / MAX_COMPOSE_SOURCES))
+    n_parts = math.ceil(size / chunk_size)
+    parts = [bucket.blob(f'{blobname}.part-{i:02d}') for i in range(n_parts)]
+
+    def upload_part(i):
+        with open(filename, 'rb') as f:
+            f.seek(i * chunk_size)
+            parts[i].upload_from_string(f.read(chunk_size), 'application/octet-stream')
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(upload_part, range(n_parts)))
+        bucket.blob(blobname).compose(parts)
+    finally:
+        for part in parts:
+            try:
+                part.delete()
+            except Exception:
+                logging.warning(f'Could not delete composite part {part.name}')
+
+
+def _sliced_download(blob, filename: str, chunk_size: int, max_workers: int) -> None:
+    """Download blob as parallel byte ranges written into one local file, then verify its checksum"""
+    with open(filename, 'wb') as f:
+        f.truncate(blob.size)
+
+    def download_slice(start):
+        data = blob.download_as_bytes(start=start, end=min(start + chunk_size, blob.size) - 1, checksum=None)
+        with open(filename, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(download_slice, range(0, blob.size, chunk_size)))
+
+    if blob.crc32c is not None and file_crc32c(filename) != blob.crc32c:
+        raise IOError(f'Checksum mismatch downloading gs://{blob.bucket.name}/{blob.name} to {filename}')
+
+
+def upload_files_to_bucket(files: list,
+                           bucketname: str,
+                           src_dir: str = None,
+                           prefix: str = '',
+                           client: storage.Client = None,
+                           max_workers: int = 8,
+                           chunk_size_mb: int = 64,
+                           skip_matching: bool = True
+                           ) -> dict:
+    """
+    Upload many local files to a bucket in parallel with one client. Files larger than chunk_size_mb use parallel
+    composite uploads, and files whose crc32c matches the existing blob are skipped.
+    @param files list of file paths, relative to src_dir if given
+    @param bucketname name of destination bucket
+    @param src_dir local directory containing the files
+    @param prefix blob name prefix, blob names are prefix + file path relative to src_dir (or file name)
+    @param client storage client, defaults to a shared client
+    @param max_workers number of parallel transfers (and parts per large file)
+    @param chunk_size_mb size above which files are split into parts
+    @param skip_matching skip files whose checksum matches the existing blob
+    @return dict with lists of uploaded and skipped blob names
+    """
+    client = client or get_storage_client()
+    bucket = client.bucket(bucketname)
+    chunk_size = chunk_size_mb * 1024 ** 2
+
+    # one list call for existing checksums instead of a metadata call per file
+    existing = {}
+    if skip_matching:
+        existing = {blob.name: blob.crc32c for blob in client.list_blobs(bucketname, prefix=prefix or None)}
+
+    small, large, skipped = [], [], []
+    for file in files:
+        filename = str(Path(src_dir) / file) if src_dir is not None else str(file)
+        blobname = f'{prefix}{Path(file).as_posix() if src_dir is not None else Path(file).name}'
+        if blobname in existing and existing[blobname] == file_crc32c(filename):
+            skipped.append(blobname)
+            continue
+        size = os.path.getsize(filename)
+        (large if size > chunk_size else small).append((filename, blobname, size))
+
+    def upload_file(item):
+        filename, blobname, _ = item
+        bucket.blob(blobname).upload_from_filename(filename)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(upload_file, small))
+    for filename, blobname, size in large:
+        _composite_upload(bucket, filename, blobname, size, chunk_size, max_workers)
+
+    uploaded = [x[1] for x in small + large]
+    logging.info(f'Uploaded {len(uploaded)} files to gs://{bucketname}/{prefix}, skipped {len(skipped)} unchanged')
+    return {'uploaded': uploaded, 'skipped': skipped}
+
+
+def upload_dir_to_bucket(src_dir: str, bucketname: str, prefix: str = '', pattern: str = '**/*', **kwargs) -> dict:
+    """
+    Upload every file in a local directory to a bucket prefix, see upload_files_to_bucket for options
+    @param src_dir local directory
+    @param bucketname name of destination bucket
+    @param prefix blob name prefix
+    @param pattern glob pattern of files to upload, relative to src_dir
+    """
+    files = [x.relative_to(src_dir) for x in Path(src_dir).glob(pattern) if x.is_file()]
+    return upload_files_to_bucket(files, bucketname, src_dir=src_dir, prefix=prefix, **kwargs)
+
+
+def download_files_from_bucket(bucketname: str,
+                               dest_dir: str,
+                               blobnames: list = None,
+                               prefix: str = None,
+                               client: storage.Client = None,
+                               max_workers: int = 8,
+                               chunk_size_mb: int = 64,
+                               skip_matching: bool = True
+                               ) -> dict:
+    """
+    Download many blobs, listed by name or by prefix, in parallel with one client. Blobs larger than
+    chunk_size_mb are downloaded as parallel slices, and local files whose crc32c matches are skipped.
+    @param bucketname name of source bucket
+    @param dest_dir local directory, files are written to dest_dir/<blob name relative to prefix>
+    @param blobnames list of blob names to download
+    @param prefix if blobnames is None, download every blob under prefix
+    @param client storage client, defaults to a shared client
+    @param max_workers number of parallel transfers (and slices per large blob)
+    @param chunk_size_mb size above which blobs are downloaded in slices
+    @param skip_matching skip blobs whose checksum matches the local file
+    @return dict with lists of downloaded and skipped blob names
+    """
+    client = client or get_storage_client()
+    bucket = client.bucket(bucketname)
+    chunk_size = chunk_size_mb * 1024 ** 2
+
+    if blobnames is None:
+        blobs = [x for x in client.list_blobs(bucketname, prefix=prefix) if not x.name.endswith('/')]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            blobs = list(executor.map(bucket.get_blob, blobnames))
+        missing = [name for name, blob in zip(blobnames, blobs) if blob is None]
+        if missing:
+            raise FileNotFoundError(f'Blobs not found in gs://{bucketname}: {missing}')
+
+    small, large, skipped = [], [], []
+    for blob in blobs:
+        relative = blob.name[len(prefix):].lstrip('/') if prefix else blob.name
+        filename = str(Path(dest_dir) / relative)
+        if skip_matching and os.path.exists(filename) and file_crc32c(filename) == blob.crc32c:
+            skipped.append(blob.name)
+            continue
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        (large if blob.size > chunk_size else small).append((blob, filename))
+
+    def download_blob(item):
+        blob, filename = item
+        blob.download_to_filename(filename)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(download_blob, small))
+    for blob, filename in large:
+        _sliced_download(blob, filename, chunk_size, max_workers)
+
+    downloaded = [x[0].name for x in small + large]
+    logging.info(f'Downloaded {len(downloaded)} files from gs://{bucketname}, skipped {len(skipped)} unchanged')
+    return {'downloaded': downloaded, 'skipped': skipped}
+
+
+def upload_file_to_bucket(src_filename, src_dir, bucket, blobname, client: storage.Client = None):
+    """Upload a single file, kept for existing callers, use upload_files_to_bucket for many files"""
+    client = client or get_storage_client()
+    client.bucket(bucket).blob(blobname).upload_from_filename(f'{src_dir}/{src_filename}')
+
+
+def download_file_from_bucket(bucketname, blobname, destination_file_name, client: storage.Client = None):
+    """Download a single file, kept for existing callers, use download_files_from_bucket for many files"""
+    client = client or get_storage_client()
+    client.bucket(bucketname).blob(blobname).download_to_filename(destination_file_name)
@@ -0,0 +1,118 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from utils.io import json_to_dict
+
+
+BOOLEAN_VALUES = {'true', 'false', '1', '0', 't', 'f', 'yes', 'no', 'y', 'n'}
+
+
+def parse_timestamps(series: pd.Series) -> pd.Series:
+    """Parse a column to utc timestamps, unparseable values become NaT"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    try:
+        return pd.to_datetime(series, errors='coerce', utc=True, format='mixed')
+    except (TypeError, ValueError):
+        return pd.to_datetime(series, errors='coerce', utc=True)
+
+
+def uncoercible_mask(series: pd.Series, bq_type: str) -> pd.Series:
+    """
+    Find non-null values which bigquery will not be able to load as the column type
+    @param series column to check
+    @param bq_type bigquery type from the schema
+    @return boolean series, true for values which cannot be coerced
+    """
+    notnull = series.notna()
+    if bq_type in ('INTEGER', 'INT64'):
+        numeric = pd.to_numeric(series, errors='coerce')
+        return notnull & (numeric.isna() | (numeric != np.floor(numeric)))
+    elif bq_type in ('FLOAT', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC'):
+        return notnull & pd.to_numeric(series, errors='coerce').isna()
+    elif bq_type in ('BOOLEAN', 'BOOL'):
+        if pd.api.types.is_bool_dtype(series):
+            return pd.Series(False, index=series.index)
+        return notnull & ~series.astype(str).str.lower().isin(BOOLEAN_VALUES)
+    elif bq_type in ('TIMESTAMP', 'DATETIME', 'DATE'):
+        return notnull & parse_timestamps(series).isna()
+    return pd.Series(False, index=series.index)
+
+
+def conform_columns(dataframe: pd.DataFrame, schema_columns: list) -> pd.DataFrame:
+    """
+    Order columns as in the schema and add missing columns as nulls, csv files are loaded by column position.
+    Columns not in the schema are kept at the end, _etl_loaded_at is left to be inserted by upload.
+    @param dataframe dataframe to conform
+    @param schema_columns column names in schema order
+    @return dataframe with schema columns in schema order, the same object if already conformed
+    """
+    schema_columns = [x for x in schema_columns if x != '_etl_loaded_at']
+    columns = schema_columns + [x for x in dataframe.columns if x not in schema_columns]
+    if list(dataframe.columns) == columns:
+        return dataframe
+    return dataframe.reindex(columns=columns)
+
+
+def validate_dataframe(dataframe: pd.DataFrame, schema_path: str, table_id: str = None, partition_col: str = None,
+                       file_type: str = None) -> tuple:
+    """
+    Validate a dataframe against a bigquery schema json file before upload, checking required columns,
+    nullability, type coercibility and timestamp parsing of the partition column. Valid rows are returned with
+    integer columns cast to nullable Int64, and for csv with columns conformed to the schema order.
+    @param dataframe dataframe to validate
+    @param schema_path path to bigquery schema
+    @param table_id name of table, for the report
+    @param partition_col name of partition column, if time partitioned
+    @param file_type file type of the upload (e.g. csv)
+    @return tuple of valid rows, invalid rows with an _errors column, and a report dictionary
+    """
+    schema = json_to_dict(schema_path)
+    errors = pd.Series('', index=dataframe.index)
+    invalid = pd.Series(False, index=dataframe.index)
+    report = {'table': table_id, 'rows': len(dataframe.index), 'errors': {}}
+
+    def flag(mask, column, reason):
+        n = int(mask.sum())
+        if n:
+            errors[mask] = errors[mask] + f'{column}: {reason}; '
+            invalid[mask] = True
+            report['errors'][f'{column}: {reason}'] = n
+
+    schema_columns = [x['name'] for x in schema]
+    report['missing_columns'] = [x['name'] for x in schema if x['name'] not in dataframe.columns and x.get('mode') == 'REQUIRED']
+    report['unexpected_columns'] = [x for x in dataframe.columns if x not in schema_columns and x != '_etl_loaded_at']
+    if file_type == 'csv':
+        present = [x for x in dataframe.columns if x in schema_columns]
+        report['missing_nullable_columns'] = [x['name'] for x in schema if x['name'] not in dataframe.columns
+                                              and x.get('mode') != 'REQUIRED' and x['name'] != '_etl_loaded_at']
+        report['reordered_columns'] = present != [x for x in schema_columns if x in present]
+        dataframe = conform_columns(dataframe, schema_columns)
+
+    for field in schema:
+        name = field['name']
+        if name not in dataframe.columns:
+            continue
+        series = dataframe[name]
+        if field.get('mode') == 'REQUIRED':
+            flag(series.isna(), name, 'null in required column')
+        if name == partition_col:
+            flag(series.notna() & parse_timestamps(series).isna(), name, 'unparseable partition timestamp')
+        else:
+            flag(uncoercible_mask(series, field['type']), name, f"not coercible to {field['type']}")
+
+    report['invalid_rows'] = int(invalid.sum())
+    report['valid'] = not report['missing_columns'] and not report['unexpected_columns'] and report['invalid_rows'] == 0
+    if report.get('missing_nullable_columns') or report.get('reordered_columns'):
+        logging.warning(f"Conformed {table_id} to schema column order for csv, "
+                        f"filled missing nullable columns {report['missing_nullable_columns']} with nulls")
+    logging.info(f'Validation report: {report}')
+
+    # integer columns with nulls are float in pandas and serialise as 1.0, which bigquery rejects for INT64
+    valid = dataframe.loc[~invalid]
+    integer_columns = [x['name'] for x in schema if x['type'] in ('INTEGER', 'INT64') and x['name'] in valid.columns
+                       and not pd.api.types.is_integer_dtype(valid[x['name']])]
+    if integer_columns:
+        valid = valid.assign(**{x: pd.to_numeric(valid[x]).astype('Int64') for x in integer_columns})
+    return valid, dataframe.loc[invalid].assign(_errors=errors[invalid]), report
@@ -1 +1,2 @@
-from .base import Ingest
\ No newline at end of file
+from .base import Ingest
+from .transform import register_transform
\ No newline at end of file
@@ -0,0 +1,207 @@
+import copy
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from gcp import GcpConnector
+from gcp.bigquery import get_partition_range
+
+
+PARTITION_TYPES = ('DAY', 'MONTH', 'YEAR')
+
+
+def plan_backfill(start_date: str, end_date: str, step: str = 'DAY') -> list:
+    """
+    Plan the extract dates for a backfill, one per day or one per partition
+    @param start_date first date to backfill (YYYYMMDD)
+    @param end_date last date to backfill (YYYYMMDD), inclusive
+    @param step DAY, MONTH or YEAR, for MONTH/YEAR one run is planned on the last date of each partition in the range
+    @return list of extract dates (YYYYMMDD)
+    """
+    start = datetime.strptime(start_date, "%Y%m%d")
+    end = datetime.strptime(end_date, "%Y%m%d")
+    if end < start:
+        raise ValueError(f'end_date {end_date} is before start_date {start_date}')
+
+    dates = []
+    dt = start
+    while dt <= end:
+        _, partition_end = get_partition_range(dt, step)
+        run_date = min(partition_end, end)
+        dates.append(run_date.strftime("%Y%m%d"))
+        dt = partition_end + timedelta(days=1)
+    return dates
+
+
+def plan_writes(upload_kwargs: dict, table_name: str, extract_date: str) -> set:
+    """
+    What a run writes to a table: the time partitions of its upload window, or the whole table for
+    truncate, merge and integer range uploads, whose partitions depend on the data
+    @param upload_kwargs upload arguments of the table, see Ingest.get_upload_kwargs
+    @param table_name name of table
+    @param extract_date extract date of the run (YYYYMMDD)
+    @return set of (table name, partition id) tuples, with a None partition id for the whole table
+    """
+    window, partition_type = upload_kwargs.get('window'), upload_kwargs.get('partition_type')
+    if window is None or upload_kwargs.get('bucketname') is None or partition_type not in PARTITION_TYPES:
+        return {(table_name, None)}
+
+    # same partitions as GcpConnector.upload_dataframe_to_table_with_partition_via_bucket
+    writes = set()
+    dt = datetime.strptime(extract_date, "%Y%m%d") - timedelta(days=upload_kwargs.get('lag') or 0)
+    for _ in range(window):
+        partition_start, _ = get_partition_range(dt, partition_type)
+        writes.add((table_name, partition_start.strftime("%Y%m%d")))
+        dt = partition_start - timedelta(days=1)
+    return writes
+
+
+def plan_dependencies(ingest, dates: list) -> dict:
+    """
+    Find the earlier dates each date of a backfill has to wait for, because their runs write the same table or
+    partition. Overlapping runs then execute one after another in ascending order, so later extracts win.
+    @param ingest Ingest instance of the source, for the upload configuration and table selection
+    @param dates extract dates in ascending order
+    @return dictionary of extract date to set of earlier extract dates
+    """
+    tables = [x for x in ingest.table_names() if ingest.is_table_selected(x)]
+    upload_kwargs = {x: ingest.get_upload_kwargs(x) for x in tables}
+    for name, kwargs in upload_kwargs.items():
+        if kwargs.get('window') is None and not kwargs.get('merge'):
+            logging.warning(f'Table {name} has neither a window nor merge, every backfill date overwrites the whole '
+                            f'table so dates run one at a time and the table is left with the last date')
+
+    def overlaps(a: set, b: set) -> bool:
+        shared = {name for name, _ in a} & {name for name, _ in b}
+        return bool(a & b) or any((name, None) in a or (name, None) in b for name in shared)
+
+    writes = {x: set().union(*(plan_writes(upload_kwargs[name], name, x) for name in tables)) for x in dates}
+    return {x: {y for y in dates[:i] if overlaps(writes[x], writes[y])} for i, x in enumerate(dates)}
+
+
+class BackfillCheckpoint:
+    """
+    Record of completed extract dates, stored as json locally or in a storage bucket (gs://bucket/path.json),
+    so an interrupted backfill resumes where it stopped
+    @param path local path or gs:// uri of the checkpoint file
+    @param storage_client storage client, required for gs:// paths
+    """
+    def __init__(self, path: str, storage_client=None) -> None:
+        self.path = path
+        self.storage_client = storage_client
+        self._lock = threading.Lock()
+        self.completed = set(self.__read())
+
+
+    def __blob(self):
+        bucketname, blobname = self.path[len('gs://'):].split('/', 1)
+        return self.storage_client.bucket(bucketname).blob(blobname)
+
+
+    def __read(self) -> list:
+        try:
+            if self.path.startswith('gs://'):
+                blob = self.__blob()
+                return json.loads(blob.download_as_text()).get('completed', []) if blob.exists() else []
+            with open(self.path) as f:
+                return json.load(f).get('completed', [])
+        except FileNotFoundError:
+            return []
+
+
+    def __write(self) -> None:
+        content = json.dumps({'completed': sorted(self.completed)}, indent=4)
+        if self.path.startswith('gs://'):
+            self.__blob().upload_from_string(content, 'application/json')
+        else:
+            with open(self.path, 'w') as f:
+                f.write(content)
+
+
+    def mark_complete(self, extract_date: str) -> None:
+        """Add extract date to completed dates and persist the checkpoint"""
+        with self._lock:
+            self.completed.add(extract_date)
+            self.__write()
+
+
+def run_backfill(ingest_cls,
+                 config: dict,
+                 start_date: str,
+                 end_date: str,
+                 overrides: dict = None,
+                 step: str = 'DAY',
+                 max_workers: int = 4,
+                 checkpoint: str = None,
+                 gcp_connector: GcpConnector = None
+                 ) -> dict:
+    """
+    Run an ingest for every planned date in a range with bounded concurrency, sharing one GcpConnector.
+    Dates whose runs write the same table or partition run one after another in ascending order, see plan_dependencies.
+    @param ingest_cls Ingest child class of the source
+    @param config source config, copied for each run
+    @param start_date first date to backfill (YYYYMMDD)
+    @param end_date last date to backfill (YYYYMMDD), inclusive
+    @param overrides overrides for default config, applied to every run
+    @param step DAY, MONTH or YEAR, see plan_backfill
+    @param max_workers maximum number of runs in flight
+    @param checkpoint local path or gs:// uri to record completed dates, completed dates are skipped on rerun
+    @param gcp_connector shared instance of GcpConnector, created from the config if None
+    @return summary with completed, skipped and failed extract dates
+    """
+    def new_ingest(extract_date):
+        return ingest_cls(copy.deepcopy(config), extract_date, copy.deepcopy(overrides))
+
+    if gcp_connector is None:
+        gcp_connector = new_ingest(start_date).get_gcp_connector()
+
+    dates = plan_backfill(start_date, end_date, step)
+    state = BackfillCheckpoint(checkpoint, gcp_connector.storage_client) if checkpoint is not None else None
+    skipped = [x for x in dates if state is not None and x in state.completed]
+    todo = [x for x in dates if x not in skipped]
+    logging.info(f'Backfilling {len(todo)} of {len(dates)} dates from {start_date} to {end_date} with {max_workers} workers')
+
+    dependencies = plan_dependencies(new_ingest(start_date), todo)
+
+    completed, failed = [], []
+    pending, running = list(todo), {}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # start dates in ascending order once every earlier date writing the same tables has finished
+            unfinished = set(pending) | set(running.values())
+            for extract_date in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if not dependencies[extract_date] & unfinished:
+                    pending.remove(extract_date)
+                    running[executor.submit(new_ingest(extract_date).run, gcp_connector)] = extract_date
+
+            done_futures, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                extract_date = running.pop(future)
+                try:
+                    future.result()
+                    completed.append(extract_date)
+                    if state is not None:
+                        state.mark_complete(extract_date)
+                except Exception:
+                    logging.exception(f'Backfill failed for {extract_date}')
+                    failed.append(extract_date)
+
+                done = len(completed) + len(failed)
+                elapsed = time.monotonic() - started
+                rate = done / elapsed if elapsed > 0 else 0
+                eta = (len(todo) - done) / rate if rate > 0 else 0
+                logging.info(f'Backfill progress {done}/{len(todo)} ({len(failed)} failed), '
+                             f'{rate * 60:.1f} runs/min, eta {eta:.0f}s')
+
+    return {
+        'completed': sorted(completed),
+        'skipped': skipped,
+        'failed': sorted(failed),
+        'seconds': round(time.monotonic() - started, 1),
+    }
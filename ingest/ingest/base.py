@@ -1,10 +1,17 @@
 import logging
+from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 from google.cloud import bigquery
-import requests
 from pathlib import Path
 
 from gcp import GcpConnector
+from utils.helpers import parse_table_selection, is_selected
+from .spill import SpillStore
+from .checkpoint import StageCheckpoint
+from .cache import ExtractCache
+from .scheduler import get_scheduler
+from .transform import apply_transforms
 
 
 class Ingest:
@@ -16,9 +23,11 @@ class Ingest:
     1. The class methods work with you api, create a child class that inherits all methods
     2. The class methods do not work with your api, create a child class that overrides relevant methods
     """
-    def __init__(self, config: dict, overrides: dict = None) -> None:
+    def __init__(self, config: dict, extract_date: str = None, overrides: dict = None) -> None:
 
         self.config = config
+        self.extract_date = extract_date if extract_date is not None else date.today().strftime("%Y%m%d")
+        self.transform_reports = []
 
         if overrides is not None:
             from utils.helpers import update
@@ -26,15 +35,39 @@ class Ingest:
             logging.info(f'Overriding default config with: {overrides}')
             update(self.config, overrides)
 
+        self.env = self.config['env']
+        self.source_name = self.config.get('source', {}).get('name') or type(self).__name__
+
+        # Rate limits and adaptive concurrency for api requests, shared by every run of this source
+        self.scheduler = get_scheduler(self.source_name, self.config.get('api', {}).get('scheduler'))
+
+        # Opt-in local cache of extracted tables for fast development iteration, never used by prod runs
+        config_cache = self.config.get('cache') or {}
+        self.extract_cache = None
+        if config_cache.get('dir') is not None:
+            if self.config['run_type'] == 'dev':
+                self.extract_cache = ExtractCache(config_cache['dir'], config_cache.get('ttl_hours', 24), config_cache.get('max_size_mb', 2048))
+            else:
+                logging.info(f"Ignoring extract cache for run_type {self.config['run_type']}, the cache is only used by dev runs")
+
 
     # Helper Methods
-    def download(self, endpoint: str) -> dict:
+    def is_table_selected(self, table_name: str) -> bool:
+        """
+        Check if a table is in the tables selection of the config, so partial reruns only touch requested tables
+        @param table_name name of table
+        """
+        return is_selected(table_name, parse_table_selection(self.config.get('tables')))
+
+
+    def download(self, endpoint: str, params: dict = None) -> dict:
         """
         Retrieve data from api endpoint
         @param endpoint API endpoint
+        @param params query parameters
         @return json containing api output
         """
-        r = requests.get(endpoint)
+        r = self.scheduler.get(endpoint, params=params)
         if r.status_code == 404:
             logging.info(f"Invalid api url provided: {endpoint}")
             return 404
@@ -42,6 +75,17 @@ class Ingest:
             return r.json()
         
 
+    def format_params(self, params: dict = None) -> dict:
+        """
+        Fill {extract_date} placeholders in endpoint query parameters, so runs can target a given date
+        @param params query parameters from config
+        @return formatted query parameters
+        """
+        if params is None:
+            return None
+        return {k: v.format(extract_date=self.extract_date) if isinstance(v, str) else v for k, v in params.items()}
+
+
     def to_df_dict(self, json: dict, keys: list) -> dict:
         """ 
         Re-structure data from json format to dictionary of dataframes with table name as key
@@ -55,100 +99,301 @@ class Ingest:
         return df_dict
     
 
+    def extract_endpoint(self, url: str, params: dict, keys: list, name: str = None) -> dict:
+        """
+        Download an endpoint and parse it to a dictionary of dataframes, using the extract cache if configured
+        @param url API endpoint
+        @param params query parameters
+        @param keys list of table names to parse from the endpoint output
+        @param name if set, the endpoint output is a single table with this name
+        @return dictionary of dataframes
+        """
+        if self.extract_cache is not None:
+            cached = self.extract_cache.get(url, params, self.extract_date)
+            if cached is not None and all(x in cached for x in keys):
+                return {x: cached[x] for x in keys}
+
+        logging.info(f'Downloading data from endpoint: {url}')
+        data = self.download(url, params)
+        df_dict = self.to_df_dict({name: data} if name is not None else data, keys)
+
+        if self.extract_cache is not None:
+            self.extract_cache.put(url, params, self.extract_date, df_dict)
+        return df_dict
+
+
     # Main Methods
-    def extract(self) -> dict:
+    def extract(self, sink=None) -> dict:
         """
         Extract data from source system and structure as dictionary of dataframes with table name as key
-        @return dictionary of dataframes
+        @param sink if set, called with the dictionary of dataframes of each endpoint as soon as it is extracted,
+        instead of collecting every table in the returned dictionary
+        @return dictionary of dataframes, empty if sink is set
         """
         config_api = self.config['api']
 
-        dict = {}
-        keys = [] # create list of table names
+        jobs = [] # arguments of extract_endpoint for each endpoint
         if 'endpoints' in config_api:
             for endpoint in config_api['endpoints']:
+                # endpoints returning several tables are fetched once if any of their tables are selected
+                selected = [x for x in endpoint.get('tables', [endpoint['name']]) if self.is_table_selected(x)]
+                if not selected:
+                    logging.info(f"Skipping endpoint {endpoint['name']}, no tables selected")
+                    continue
                 url = f"{config_api['baseurl']}/{endpoint['name']}/"
-                logging.info(f'Downloading data from endpoint: {url}')
-                data = self.download(url)
-                if 'tables' in endpoint:
-                    keys.extend(endpoint['tables'])
-                    dict.update(data)
-                else:
-                    keys.append(endpoint['name'])
-                    dict[endpoint['name']] = data
+                params = self.format_params(endpoint.get('params'))
+                # endpoints without tables return a single table named after the endpoint
+                jobs.append((url, params, selected, None if 'tables' in endpoint else endpoint['name']))
         else:
-            keys.extend(endpoint['tables']) # if no endpoint, assumes api returns json of dataframe objects with keys as names
-            logging.info(f'Downloading data from endpoint: {config_api["base_url"]}')
-            data = self.download(config_api['base_url'])
-            dict.update(data)
+            # if no endpoint, assumes api returns json of dataframe objects with keys as names
+            keys = [x for x in config_api['tables'] if self.is_table_selected(x)]
+            jobs.append((config_api['base_url'], self.format_params(config_api.get('params')), keys, None))
 
-        return self.to_df_dict(dict, keys)
+        df_dict = {}
+        if sink is None:
+            sink = df_dict.update
+
+        # endpoints are fetched concurrently, the scheduler limits requests in flight and rate
+        if len(jobs) > 1 and self.scheduler.max_in_flight > 1:
+            with ThreadPoolExecutor(max_workers=self.scheduler.max_in_flight) as executor:
+                futures = [executor.submit(self.extract_endpoint, *job) for job in jobs]
+                for future in as_completed(futures):
+                    sink(future.result())
+        else:
+            for job in jobs:
+                sink(self.extract_endpoint(*job))
+
+        logging.info(f'API scheduler stats: {self.scheduler.stats()}')
+        return df_dict
 
 
     def transform(self, df_dict_raw: dict) -> dict:
         """
-        Apply transformations to dataframes, if no transformations, return param
+        Apply transformations declared under transform.tables in config, if no transformations, return param.
+        Tables are transformed concurrently and a per table report is added to self.transform_reports,
+        tables which fail to transform are dropped so the rest can still be loaded.
         @param df_dict raw dictionary of dataframes
         @return transformed dictionary of dataframes
         """
-        df_dict_transformed = df_dict_raw
+        df_dict_raw = {name: df for name, df in df_dict_raw.items() if self.is_table_selected(name)}
+        df_dict_transformed, reports = apply_transforms(df_dict_raw, self.config.get('transform'))
+        self.transform_reports.extend(reports)
         return df_dict_transformed
 
 
+    def get_upload_kwargs(self, table_name: str) -> dict:
+        """
+        Upload arguments of a table, the global upload configuration overridden by the table's own configuration
+        @param table_name name of table
+        @return keyword arguments for GcpConnector.upload
+        """
+        upload_kwargs = self.config['gcp']['upload'].copy()
+        # Override with env specific arguments
+        if isinstance(upload_kwargs.get('bucketname'), dict):
+            upload_kwargs['bucketname'] = upload_kwargs['bucketname'][self.env]
+        upload_kwargs['extract_date'] = datetime.strptime(self.extract_date, "%Y%m%d")
+
+        # Allow indidual tables to overwrite global upload config
+        config_tables = upload_kwargs.pop('tables', None) or {}
+        upload_kwargs.update(config_tables.get(table_name) or {})
+        return upload_kwargs
+
+
+    def table_names(self) -> list:
+        """Names of the tables declared in the api and upload configuration, before table selection"""
+        config_api = self.config['api']
+        if 'endpoints' in config_api:
+            names = [x for endpoint in config_api['endpoints'] for x in endpoint.get('tables', [endpoint['name']])]
+        else:
+            names = list(config_api['tables'])
+        names += [x for x in (self.config['gcp']['upload'].get('tables') or {}) if x not in names]
+        return names
+
+
     def load(self, df_dict_transformed: dict, gcp_connector: GcpConnector) -> None:
         """
         Load dictionary of dataframes to bigquery using upload configuration
         @param df_dict_transformed dictionary of dataframes from transform step
         @param gcp_connector instance of GcpConnector
         """
-        env = self.env
-        config_gcp = self.config['gcp']
+        df_dict_transformed = {name: df for name, df in df_dict_transformed.items() if self.is_table_selected(name)}
+        for dataframe_name, dataframe in df_dict_transformed.items():
+            gcp_connector.upload(dataframe = dataframe, table_id = dataframe_name, **self.get_upload_kwargs(dataframe_name))
 
-        upload_kwargs = config_gcp['upload']
-        # Override with env specific arguments
-        upload_kwargs['bucketname'] = upload_kwargs['bucketname'][env]
 
-        # Allow indidual tables to overwrite global upload config
-        if 'tables' in upload_kwargs:
-            for dataframe_name, dataframe in df_dict_transformed.items():
-                table_kwargs = upload_kwargs.copy()
-                table_kwargs.pop('tables')
-                if dataframe_name in upload_kwargs['tables']:
-                    for kwarg in upload_kwargs['tables'][dataframe_name]:
-                        table_kwargs[kwarg] = upload_kwargs['tables'][dataframe_name][kwarg]
-                gcp_connector.upload(dataframe = dataframe, table_id = dataframe_name, **table_kwargs)
-                                    
-        else:
-            for dataframe_name, dataframe in df_dict_transformed.items():
-                gcp_connector.upload(dataframe = dataframe, table_id = dataframe_name,  **upload_kwargs)
+    def run_with_memory_budget(self, gcp_connector: GcpConnector) -> None:
+        """
+        Run transform and load one table at a time, spilling tables above the memory budget to Arrow files.
+        In this mode transform is called with a single-table dictionary, so transforms must not depend on
+        other tables.
+        @param gcp_connector instance of GcpConnector
+        """
+        config_memory = self.config['memory']
+
+        with SpillStore(config_memory['budget_mb'], config_memory.get('spill_dir')) as store:
+
+            ## Step 1: Move the tables of each endpoint into the store as soon as it is extracted
+            def spill(df_dict_raw: dict) -> None:
+                for name in list(df_dict_raw):
+                    store.put(name, df_dict_raw.pop(name))
 
+            self.extract(sink=spill)
 
-    def run(self) -> None:
+            ## Step 2: Transform tables one at a time
+            for name in store.names():
+                df_dict_transformed = self.transform({name: store.pop(name)})
+                for transformed_name in list(df_dict_transformed):
+                    store.put(transformed_name, df_dict_transformed.pop(transformed_name))
+                del df_dict_transformed
+
+            ## Step 3: Load and release tables one at a time
+            for name in store.names():
+                self.load({name: store.pop(name)}, gcp_connector)
+
+
+    def run_with_checkpoint(self, gcp_connector: GcpConnector) -> None:
         """
-        Ingestion process runner method to download, parse and upload api data into bigquery
-        @param env environment determines which authentication method is used for GCP
-        @param overrides overrides for default config, dict with same structure as config
+        Run the ETL process persisting extracted and transformed tables, so a retry of a failed run skips
+        completed stages and only re-drives the loads which failed. Checkpoints are cleared when the run
+        succeeds, set checkpoint.resume to false to start over instead of resuming a failed run.
+        If memory.budget_mb is also set, tables are held in a SpillStore and transformed and loaded one at
+        a time as in run_with_memory_budget.
+        @param gcp_connector instance of GcpConnector
         """
-        env = self.env
-        config_gcp = self.config['gcp']
-        config_gcp['key_file'] = config_gcp['key_file'][env]
+        config_checkpoint = self.config['checkpoint']
+        config_memory = self.config.get('memory') or {}
+        checkpoint = StageCheckpoint(config_checkpoint['path'], self.source_name, self.extract_date, gcp_connector.credentials)
+        if config_checkpoint.get('retention_days') is not None:
+            checkpoint.garbage_collect(config_checkpoint['retention_days'])
+        if not config_checkpoint.get('resume', True):
+            logging.info(f'Resume disabled, clearing checkpoint of {self.source_name} for {self.extract_date}')
+            checkpoint.clear()
 
-        # ETL Process
+        stream = config_memory.get('budget_mb') is not None
+        n_reports = len(self.transform_reports)
+        selection = parse_table_selection(self.config.get('tables'))
+
+        with SpillStore(config_memory['budget_mb'] if stream else float('inf'), config_memory.get('spill_dir')) as store:
+
+            def put(stage: str, df_dict: dict) -> bool:
+                """Checkpoint tables of a stage and move them into the store"""
+                saved = checkpoint.save_tables(stage, df_dict)
+                for name in list(df_dict):
+                    store.put(name, df_dict.pop(name))
+                return saved
 
-        ## Step 1: Download data as dictionary and parse to dictionary of dataframes
-        df_dict_raw = self.extract()
+            ## Step 1 & 2: Reuse transformed tables if transform completed, otherwise transform extracted tables
+            transformed = checkpoint.completed_tables('transformed', selection)
+            if transformed is not None:
+                names = [x for x in transformed if self.is_table_selected(x) and not checkpoint.is_loaded(x)]
+                logging.info(f'Resuming from transformed checkpoint: {names}')
+            else:
+                extracted = checkpoint.completed_tables('extracted', selection)
+                if extracted is not None:
+                    extracted = [x for x in extracted if self.is_table_selected(x)]
+                    logging.info(f'Resuming from extracted checkpoint: {extracted}')
+                    for name in extracted:
+                        store.put(name, checkpoint.read('extracted', [name])[name])
+                else:
+                    extracted, saved = [], []
+                    def extract_sink(df_dict_raw: dict) -> None:
+                        extracted.extend(df_dict_raw)
+                        saved.append(put('extracted', df_dict_raw))
+                    self.extract(sink=extract_sink)
+                    if all(saved):
+                        checkpoint.mark_complete('extracted', extracted, selection)
+
+                # with a memory budget tables are transformed one at a time, so transforms must not depend on other tables
+                names, saved = [], []
+                for batch in ([[x] for x in extracted] if stream else [extracted]):
+                    df_dict_transformed = self.transform({x: store.pop(x) for x in batch})
+                    names.extend(df_dict_transformed)
+                    saved.append(put('transformed', df_dict_transformed))
+                # Only mark transform complete if no table failed, so a retry transforms failed tables again
+                if all(saved) and all(x['status'] != 'failed' for x in self.transform_reports[n_reports:]):
+                    checkpoint.mark_complete('transformed', names, selection)
+
+            ## Step 3: Load tables without a completion marker, releasing each one after its load
+            failed = []
+            for name in names:
+                if checkpoint.is_loaded(name):
+                    logging.info(f'Skipping {name}, already loaded for {self.extract_date}')
+                    store.discard(name)
+                    continue
+                dataframe = store.pop(name) if name in store else checkpoint.read('transformed', [name])[name]
+                try:
+                    self.load({name: dataframe}, gcp_connector)
+                    checkpoint.mark_loaded(name, len(dataframe.index))
+                except Exception:
+                    logging.exception(f'Failed to load {name}')
+                    failed.append(name)
+                del dataframe
 
-        ## Step 2: Transform dataframes if exists
-        df_dict_transformed = self.transform(df_dict_raw)
+        if failed:
+            raise RuntimeError(f'Failed to load tables {failed}, retry to load them from checkpoint')
 
-        ## Step 3: Upload dictionary of dataframes to bq tables
+        ## Keep checkpoints of tables which failed to transform for the retry, otherwise the run is complete
+        if all(x['status'] != 'failed' for x in self.transform_reports[n_reports:]):
+            checkpoint.clear()
+
+
+    def raise_for_failed_transforms(self, reports: list = None) -> None:
+        """
+        Raise if any table failed to transform, called after the other tables are loaded so one bad table
+        does not block the rest but the run still fails
+        @param reports transform reports to check, defaults to self.transform_reports
+        """
+        reports = self.transform_reports if reports is None else reports
+        failed = [x['table'] for x in reports if x['status'] == 'failed']
+        if failed:
+            raise RuntimeError(f'Failed to transform tables {failed}, see transform reports for errors')
+
+
+    def get_gcp_connector(self) -> GcpConnector:
+        """
+        Create GcpConnector for the run type, bq config only required for local development
+        @return instance of GcpConnector
+        """
+        env = self.env
+        config_gcp = self.config['gcp']
+        if isinstance(config_gcp['key_file'], dict):
+            config_gcp['key_file'] = config_gcp['key_file'][env]
 
-        ### bq config only required for local development
         if self.config['run_type'] == 'dev':
-            gcp_connector = GcpConnector(config_gcp)
+            return GcpConnector(config_gcp)
         elif self.config['run_type'] == 'prod':
-            gcp_connector = GcpConnector()
+            return GcpConnector()
+        raise ValueError("run_type must be dev or prod")
+
+
+    def run(self, gcp_connector: GcpConnector = None) -> None:
+        """
+        Ingestion process runner method to download, parse and upload api data into bigquery
+        @param gcp_connector shared instance of GcpConnector (e.g. for backfills), created from config if None
+        """
+        if gcp_connector is None:
+            gcp_connector = self.get_gcp_connector()
+        n_reports = len(self.transform_reports)
+
+        # ETL Process
+
+        ## Checkpoint mode: persist each stage so retries resume without re-extracting, within memory.budget_mb if set
+        if self.config.get('checkpoint', {}).get('path') is not None:
+            self.run_with_checkpoint(gcp_connector)
+
+        ## Memory budget mode: stream tables through transform and load one at a time
+        elif self.config.get('memory', {}).get('budget_mb') is not None:
+            self.run_with_memory_budget(gcp_connector)
+
         else:
-            return "Env must be dev or prod"
+            ## Step 1: Download data as dictionary and parse to dictionary of dataframes
+            df_dict_raw = self.extract()
+
+            ## Step 2: Transform dataframes if exists
+            df_dict_transformed = self.transform(df_dict_raw)
+
+            ## Step 3: Upload dictionary of dataframes to bq tables
+            self.load(df_dict_transformed, gcp_connector)
 
-        return self.load(df_dict_transformed, gcp_connector)
+        ## Tables which failed to transform were skipped by load, fail the run once the rest are loaded
+        self.raise_for_failed_transforms(self.transform_reports[n_reports:])
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import pyarrow as pa
+from pyarrow import feather
+
+
+class ExtractCache:
+    """
+    Local on-disk cache of extracted tables for development runs, keyed by endpoint url, params and extract date.
+    Tables are stored as uncompressed Arrow (feather) files so they are reloaded through a memory map.
+    @param cache_dir directory for cache entries
+    @param ttl_hours entries older than this are treated as missing
+    @param max_size_mb total size of the cache, least recently used entries are evicted above it
+    """
+    _lock = threading.Lock() # shared by every cache instance, concurrent extracts and backfill runs write the same directory
+
+    def __init__(self, cache_dir: str, ttl_hours: float = 24, max_size_mb: float = 2048) -> None:
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_size_bytes = int(max_size_mb * 1024 ** 2)
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def key(self, url: str, params: dict, extract_date: str) -> str:
+        """Cache key of an endpoint request"""
+        payload = json.dumps({'url': url, 'params': params, 'extract_date': extract_date}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+    def get(self, url: str, params: dict, extract_date: str) -> dict:
+        """
+        Get cached tables of an endpoint request
+        @return dictionary of dataframes, or None if missing or expired
+        """
+        entry_dir = os.path.join(self.cache_dir, self.key(url, params, extract_date))
+        meta_path = os.path.join(entry_dir, '_meta.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if time.time() - meta['created_at'] > self.ttl_seconds:
+                logging.info(f'Cache entry for {url} expired')
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+
+            os.utime(entry_dir) # mark as recently used for eviction
+            logging.info(f'Loading {meta["tables"]} from cache for {url}')
+            return {
+                name: feather.read_table(os.path.join(entry_dir, f'{i}.arrow'), memory_map=True).to_pandas()
+                for i, name in enumerate(meta['tables'])
+            }
+        except FileNotFoundError: # missing, or evicted by a concurrent run
+            return None
+
+
+    def put(self, url: str, params: dict, extract_date: str, df_dict: dict) -> None:
+        """Cache tables of an endpoint request, then evict entries above the size limit"""
+        entry_dir = os.path.join(self.cache_dir, self.key(url, params, extract_date))
+        with self._lock:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.makedirs(entry_dir)
+            try:
+                for i, dataframe in enumerate(df_dict.values()):
+                    feather.write_feather(dataframe, os.path.join(entry_dir, f'{i}.arrow'), compression='uncompressed')
+            except (pa.ArrowException, TypeError, ValueError) as e:
+                logging.warning(f'Could not cache {url} ({e})')
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return
+            with open(os.path.join(entry_dir, '_meta.json'), 'w') as f:
+                json.dump({'url': url, 'params': params, 'extract_date': extract_date,
+                           'tables': list(df_dict), 'created_at': time.time()}, f, default=str)
+            self.__evict()
+
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache is within max_size_mb"""
+        with self._lock:
+            self.__evict()
+
+
+    def __evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            try:
+                size = sum(x.stat().st_size for x in os.scandir(entry_dir))
+                entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+            except (FileNotFoundError, NotADirectoryError): # removed by another process, or not an entry
+                continue
+        total = sum(x[1] for x in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_size_bytes:
+                break
+            logging.info(f'Evicting cache entry {entry_dir}')
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+    def clear(self) -> None:
+        """Remove every cache entry"""
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
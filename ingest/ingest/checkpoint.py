@@ -0,0 +1,141 @@
+import json
+import logging
+from datetime import datetime, timedelta
+import fsspec
+import pandas as pd
+
+
+class StageCheckpoint:
+    """
+    Persist extracted and transformed tables of a run as parquet, with completion markers per stage and per
+    loaded table, so a failed run can be retried without re-extracting. Checkpoints are stored under
+    <path>/<source>/<extract_date>/ in a local directory or a storage bucket (gs://bucket/prefix) and are
+    cleared once a run succeeds.
+    @param path local directory or gs:// uri for checkpoints
+    @param source name of source
+    @param extract_date extract date of the run (YYYYMMDD)
+    @param credentials google credentials for gs:// paths (e.g. of the GcpConnector), defaults to application default credentials
+    """
+    def __init__(self, path: str, source: str, extract_date: str, credentials=None) -> None:
+        storage_options = {'token': credentials} if credentials is not None and path.startswith('gs://') else {}
+        self.fs, root = fsspec.core.url_to_fs(path, **storage_options)
+        self.source_dir = f'{root.rstrip("/")}/{source}'
+        self.run_dir = f'{self.source_dir}/{extract_date}'
+        self.fs.makedirs(self.run_dir, exist_ok=True)
+        if not self.fs.exists(f'{self.run_dir}/_created.json'):
+            self.__write_json('_created.json', {'created_at': datetime.utcnow().isoformat()})
+
+
+    def __write_json(self, name: str, obj: dict) -> None:
+        with self.fs.open(f'{self.run_dir}/{name}', 'w') as f:
+            json.dump(obj, f)
+
+
+    def __read_json(self, name: str) -> dict:
+        path = f'{self.run_dir}/{name}'
+        if not self.fs.exists(path):
+            return None
+        with self.fs.open(path, 'r') as f:
+            return json.load(f)
+
+
+    # Stages
+    def completed_tables(self, stage: str, selection: list = None) -> list:
+        """
+        Tables saved by a completed stage
+        @param stage extracted or transformed
+        @param selection table selection of the run, a stage saved with a different selection is not reused
+        @return list of table names, or None if the stage has not completed
+        """
+        marker = self.__read_json(f'_{stage}.json')
+        if marker is None or marker.get('selection') != selection:
+            return None
+        return marker['tables']
+
+
+    def save_tables(self, stage: str, df_dict: dict) -> bool:
+        """
+        Save dataframes of a stage as parquet, without marking the stage complete
+        @param stage extracted or transformed
+        @param df_dict dictionary of dataframes with table name as key
+        @return true if every table was saved
+        """
+        self.fs.makedirs(f'{self.run_dir}/{stage}', exist_ok=True)
+        complete = True
+        for name, dataframe in df_dict.items():
+            try:
+                with self.fs.open(f'{self.run_dir}/{stage}/{name}.parquet', 'wb') as f:
+                    dataframe.to_parquet(f, index=False)
+            except Exception as e:
+                logging.warning(f'Could not checkpoint {stage} table {name} ({e})')
+                complete = False
+        return complete
+
+
+    def mark_complete(self, stage: str, names: list, selection: list = None) -> None:
+        """
+        Mark a stage complete once all of its tables are saved
+        @param stage extracted or transformed
+        @param names table names saved by the stage
+        @param selection table selection of the run
+        """
+        self.__write_json(f'_{stage}.json', {'tables': list(names), 'selection': selection})
+
+
+    def read(self, stage: str, names: list) -> dict:
+        """
+        Read checkpointed dataframes of a stage
+        @param stage extracted or transformed
+        @param names table names to read
+        @return dictionary of dataframes with table name as key
+        """
+        df_dict = {}
+        for name in names:
+            with self.fs.open(f'{self.run_dir}/{stage}/{name}.parquet', 'rb') as f:
+                df_dict[name] = pd.read_parquet(f)
+        return df_dict
+
+
+    # Loads
+    def is_loaded(self, name: str) -> bool:
+        """Check if table has a load completion marker"""
+        return self.fs.exists(f'{self.run_dir}/loaded/{name}.json')
+
+
+    def mark_loaded(self, name: str, rows: int = None) -> None:
+        """Write load completion marker for table"""
+        self.fs.makedirs(f'{self.run_dir}/loaded', exist_ok=True)
+        self.__write_json(f'loaded/{name}.json', {'loaded_at': datetime.utcnow().isoformat(), 'rows': rows})
+
+
+    # Clean up
+    def clear(self) -> None:
+        """Remove stage checkpoints and load markers of this run, so the next run for the extract date starts fresh"""
+        for path in self.fs.ls(self.run_dir, detail=False):
+            if path.rstrip('/').rsplit('/', 1)[-1] != '_created.json':
+                self.fs.rm(path, recursive=True)
+
+
+    def garbage_collect(self, retention_days: int) -> list:
+        """
+        Remove checkpoints of this source created more than retention_days ago
+        @param retention_days number of days to keep checkpoints
+        @return list of removed checkpoint directories
+        """
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        removed = []
+        for run_dir in self.fs.ls(self.source_dir, detail=False):
+            run_dir = run_dir.rstrip('/')
+            try:
+                with self.fs.open(f'{run_dir}/_created.json', 'r') as f:
+                    created_at = datetime.fromisoformat(json.load(f)['created_at'])
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+            if created_at < cutoff and run_dir != self.run_dir:
+                logging.info(f'Removing checkpoint {run_dir} created at {created_at}')
+                try:
+                    self.fs.rm(run_dir, recursive=True)
+                except FileNotFoundError:
+                    continue # removed by a concurrent run of the source, e.g. another backfill date
+                removed.append(run_dir)
+        return removed
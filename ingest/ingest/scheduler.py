@@ -0,0 +1,255 @@
+import time
+import bisect
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+_schedulers = {} # shared schedulers by source name and config, see get_scheduler
+_schedulers_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Token bucket rate limit, shared by every request of a source
+    @param rate tokens (requests) added per second
+    @param burst maximum number of tokens, defaults to one second of requests
+    """
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self) -> None:
+        """Block until a token is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """
+    Limit on requests in flight which adapts with additive increase and multiplicative decrease: the limit grows
+    while the api is healthy and halves on rate limits, server errors and latency spikes
+    @param min_limit lowest number of requests in flight
+    @param max_limit highest number of requests in flight
+    @param initial starting limit, defaults to min_limit
+    """
+    def __init__(self, min_limit: int = 1, max_limit: int = 8, initial: int = None) -> None:
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(initial or self.min_limit)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+
+    def acquire(self) -> None:
+        """Block until a request slot is free"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+
+    def release(self, healthy: bool) -> None:
+        """Free a request slot and adapt the limit to the outcome of the request"""
+        with self._cond:
+            self.in_flight -= 1
+            if healthy:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(self.min_limit, self.limit / 2)
+            self._cond.notify_all()
+
+
+class LatencyHistogram:
+    """Latency histogram and status counts of one endpoint, with an exponential moving average to detect spikes"""
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.statuses = {}
+        self.total_ms = 0.0
+        self.ewma_ms = None
+        self._lock = threading.Lock()
+
+
+    def record(self, latency_ms: float, status) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.total_ms += latency_ms
+            self.ewma_ms = latency_ms if self.ewma_ms is None else 0.8 * self.ewma_ms + 0.2 * latency_ms
+
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket containing the q quantile, in milliseconds"""
+        n = sum(self.counts)
+        if n == 0:
+            return None
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= q * n:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else float('inf')
+
+
+    def summary(self) -> dict:
+        n = sum(self.counts)
+        buckets = [f'<={x}ms' for x in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}ms']
+        return {
+            'requests': n,
+            'mean_ms': round(self.total_ms / n, 1) if n else None,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'statuses': dict(self.statuses),
+            'histogram': {b: c for b, c in zip(buckets, self.counts) if c},
+        }
+
+
+class Scheduler:
+    """
+    Per source request scheduler with a token bucket rate limit, an adaptive limit on requests in flight
+    and retries which honour 429 Retry-After, configured under api.scheduler in config.yaml
+    @param rate_per_second token bucket rate, None for no rate limit
+    @param burst token bucket capacity
+    @param min_in_flight lowest number of concurrent requests
+    @param max_in_flight highest number of concurrent requests
+    @param initial_in_flight starting number of concurrent requests
+    @param max_retries retries for 429, 5xx and connection errors
+    @param latency_spike_factor a request slower than this multiple of the endpoint's average latency backs off
+    @param timeout request timeout in seconds
+    """
+    def __init__(self,
+                 rate_per_second: float = None,
+                 burst: float = None,
+                 min_in_flight: int = 1,
+                 max_in_flight: int = 1,
+                 initial_in_flight: int = None,
+                 max_retries: int = 5,
+                 latency_spike_factor: float = 3,
+                 timeout: float = 60
+                 ) -> None:
+        self.bucket = TokenBucket(rate_per_second, burst) if rate_per_second else None
+        self.limiter = AdaptiveLimiter(min_in_flight, max_in_flight, initial_in_flight)
+        self.max_retries = max_retries
+        self.latency_spike_factor = latency_spike_factor
+        self.timeout = timeout
+        self.histograms = {}
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_in_flight, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    @property
+    def max_in_flight(self) -> int:
+        return self.limiter.max_limit
+
+
+    def __histogram(self, url: str) -> LatencyHistogram:
+        with self._lock:
+            if url not in self.histograms:
+                self.histograms[url] = LatencyHistogram()
+            return self.histograms[url]
+
+
+    def __pause(self, seconds: float) -> None:
+        """Pause every request of the source, e.g. after a 429"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+    def __wait_if_paused(self) -> None:
+        while True:
+            wait = self._paused_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+    def get(self, url: str, params: dict = None, **kwargs) -> requests.Response:
+        """
+        Send a GET request through the scheduler, retrying rate limited, server error and failed requests
+        @param url API endpoint
+        @param params query parameters
+        @return response of the last attempt
+        """
+        histogram = self.__histogram(url)
+        for attempt in range(self.max_retries + 1):
+            self.__wait_if_paused()
+            self.limiter.acquire()
+            healthy, r = False, None
+            try:
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                baseline = histogram.ewma_ms
+                start = time.monotonic()
+                try:
+                    r = self.session.get(url, params=params, timeout=self.timeout, **kwargs)
+                    status = r.status_code
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    logging.warning(f'Request to {url} failed ({e}), attempt {attempt + 1}')
+                    status = type(e).__name__
+                latency_ms = (time.monotonic() - start) * 1000
+                histogram.record(latency_ms, status)
+                spike = baseline is not None and latency_ms > self.latency_spike_factor * baseline
+                healthy = r is not None and r.status_code != 429 and r.status_code < 500 and not spike
+            finally:
+                self.limiter.release(healthy)
+
+            if r is not None and r.status_code == 429:
+                retry_after = r.headers.get('Retry-After')
+                try:
+                    wait = float(retry_after) if retry_after is not None else 2 ** attempt
+                except ValueError:
+                    wait = 2 ** attempt
+                logging.info(f'Rate limited by {url}, pausing source for {wait}s')
+                self.__pause(wait)
+            elif r is None or r.status_code >= 500:
+                time.sleep(min(2 ** attempt, 60))
+            else:
+                return r
+
+        if r is None:
+            raise requests.ConnectionError(f'Request to {url} failed after {self.max_retries} retries')
+        r.raise_for_status()
+        return r
+
+
+    def stats(self) -> dict:
+        """Latency histogram and status counts per endpoint, with the current concurrency limit"""
+        return {
+            'in_flight_limit': round(self.limiter.limit, 2),
+            'endpoints': {url: histogram.summary() for url, histogram in self.histograms.items()},
+        }
+
+
+def get_scheduler(source: str, config: dict = None) -> Scheduler:
+    """
+    Get the scheduler of a source, shared by every ingest of the source in this process so concurrent runs
+    (e.g. backfill dates) share one rate limit and concurrency limit instead of each getting their own
+    @param source name of source
+    @param config keyword arguments of Scheduler from api.scheduler in config.yaml
+    @return shared Scheduler
+    """
+    config = config or {}
+    key = (source, tuple(sorted(config.items())))
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = Scheduler(**config)
+        return _schedulers[key]
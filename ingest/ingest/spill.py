@@ -0,0 +1,113 @@
+import os
+import shutil
+import logging
+import tempfile
+import pandas as pd
+import pyarrow as pa
+
+
+class SpillStore:
+    """
+    Dictionary-like store of dataframes with a memory budget. Tables that would take the store over budget
+    are written to Arrow IPC files on disk and memory-mapped back when popped, so only one spilled table
+    needs to be held in memory at a time.
+    @param budget_mb memory budget for dataframes held in memory, in MiB, float('inf') never spills
+    @param spill_dir parent directory for spill files, defaults to the system temp directory
+    """
+    def __init__(self, budget_mb: float, spill_dir: str = None) -> None:
+        self.budget_bytes = budget_mb * 1024 ** 2
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = tempfile.mkdtemp(prefix='ingest-spill-', dir=spill_dir)
+        self._memory = {}
+        self._sizes = {}
+        self._spilled = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._memory or name in self._spilled
+
+
+    def __len__(self) -> int:
+        return len(self._memory) + len(self._spilled)
+
+
+    @property
+    def memory_bytes(self) -> int:
+        """Bytes of dataframes currently held in memory"""
+        return sum(self._sizes.values())
+
+
+    def names(self) -> list:
+        """Table names, in-memory tables first"""
+        return list(self._memory) + list(self._spilled)
+
+
+    def put(self, name: str, dataframe: pd.DataFrame) -> None:
+        """
+        Add dataframe to store, spilling it to disk if it does not fit in the memory budget
+        @param name table name
+        @param dataframe pandas dataframe
+        """
+        self.discard(name)
+        size = int(dataframe.memory_usage(index=True, deep=True).sum())
+        if self.memory_bytes + size <= self.budget_bytes:
+            self._memory[name] = dataframe
+            self._sizes[name] = size
+            return
+
+        path = os.path.join(self.spill_dir, f'{len(self._spilled)}-{name}.arrow')
+        try:
+            table = pa.Table.from_pandas(dataframe)
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            logging.warning(f'Could not spill {name} to arrow ({e}), keeping in memory')
+            self._memory[name] = dataframe
+            self._sizes[name] = size
+            return
+        logging.info(f'Spilled {name} ({size / 1024 ** 2:.1f} MiB) to {path}')
+        self._spilled[name] = path
+
+
+    def pop(self, name: str) -> pd.DataFrame:
+        """
+        Remove dataframe from store and return it, reading spilled tables through a memory map
+        @param name table name
+        @return pandas dataframe
+        """
+        if name in self._memory:
+            self._sizes.pop(name)
+            return self._memory.pop(name)
+
+        path = self._spilled.pop(name)
+        with pa.memory_map(path, 'r') as source:
+            dataframe = pa.ipc.open_file(source).read_all().to_pandas()
+        os.remove(path)
+        return dataframe
+
+
+    def discard(self, name: str) -> None:
+        """Remove table from store if it exists, without loading it"""
+        if name in self._memory:
+            self._memory.pop(name)
+            self._sizes.pop(name)
+        elif name in self._spilled:
+            os.remove(self._spilled.pop(name))
+
+
+    def close(self) -> None:
+        """Drop all tables and remove spill files"""
+        self._memory.clear()
+        self._sizes.clear()
+        self._spilled.clear()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
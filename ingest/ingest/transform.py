@@ -0,0 +1,158 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import pandas as pd
+
+
+# Registry of named transform functions, referenced from config under transform.tables.<table>.functions
+TRANSFORMS = {}
+
+
+def register_transform(func=None, name: str = None):
+    """
+    Decorator to register a transform function so it can be referenced by name in config.yaml.
+    Registered functions take a dataframe (plus keyword options from config) and return a dataframe.
+    @param name name used in config, defaults to the function name
+    """
+    def decorator(f):
+        TRANSFORMS[name or f.__name__] = f
+        return f
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def cast_column(series: pd.Series, dtype: str) -> pd.Series:
+    """
+    Cast a column to a dtype, timestamp and date strings are parsed with pandas
+    @param series column to cast
+    @param dtype pandas dtype, or timestamp/date
+    @return cast column
+    """
+    if dtype == 'timestamp':
+        return pd.to_datetime(series, utc=True, errors='coerce')
+    elif dtype == 'date':
+        return pd.to_datetime(series, errors='coerce').dt.normalize()
+    elif dtype in ('int', 'integer'):
+        return pd.to_numeric(series, errors='coerce').astype('Int64')
+    elif dtype == 'float':
+        return pd.to_numeric(series, errors='coerce')
+    return series.astype(dtype)
+
+
+def resolve_functions(table_config: dict) -> list:
+    """
+    Look up the registered transform functions of a table config
+    @param table_config transform config for the table
+    @return list of (function, options) tuples
+    """
+    functions = []
+    for function in table_config.get('functions', []):
+        if isinstance(function, dict):
+            (function, options), = function.items()
+        else:
+            options = {}
+        functions.append((TRANSFORMS[function], options or {}))
+    return functions
+
+
+def apply_table_transform(dataframe: pd.DataFrame, table_config: dict, report: dict = None, functions: list = None) -> pd.DataFrame:
+    """
+    Apply config-driven transform steps to a dataframe in the order rename, cast, derive, filter, dedupe, functions
+    @param dataframe raw dataframe
+    @param table_config transform config for the table
+    @param report if set, values which could not be cast and became null are counted under report['coerced']
+    @param functions resolved transform functions from resolve_functions, looked up from table_config if None
+    @return transformed dataframe
+    """
+    if functions is None:
+        functions = resolve_functions(table_config)
+
+    if 'rename' in table_config:
+        dataframe = dataframe.rename(columns=table_config['rename'])
+
+    if 'cast' in table_config:
+        cast = {col: cast_column(dataframe[col], dtype) for col, dtype in table_config['cast'].items()}
+        # casts coerce unparseable values to null, count them so bad source data is visible in the report
+        for col, series in cast.items():
+            n_coerced = int((dataframe[col].notna() & series.isna()).sum())
+            if n_coerced:
+                logging.warning(f"{n_coerced} values of {col} could not be cast to {table_config['cast'][col]} and were set to null")
+                if report is not None:
+                    report.setdefault('coerced', {})[col] = n_coerced
+        dataframe = dataframe.assign(**cast)
+
+    # derived columns are pandas eval expressions, e.g. total: price * quantity
+    for col, expression in table_config.get('derive', {}).items():
+        dataframe = dataframe.assign(**{col: dataframe.eval(expression)})
+
+    # filter is a pandas query expression, e.g. amount > 0
+    if 'filter' in table_config:
+        dataframe = dataframe.query(table_config['filter'])
+
+    if 'dedupe' in table_config:
+        dedupe = table_config['dedupe']
+        if not isinstance(dedupe, dict):
+            dedupe = {'keys': dedupe}
+        keys = dedupe['keys']
+        if 'order_by' in dedupe:
+            dataframe = dataframe.sort_values(dedupe['order_by'], kind='stable')
+        dataframe = dataframe.drop_duplicates(subset=[keys] if isinstance(keys, str) else keys, keep=dedupe.get('keep', 'last'))
+
+    for function, options in functions:
+        dataframe = function(dataframe, **options)
+
+    return dataframe.reset_index(drop=True)
+
+
+def _run_table_transform(table_name: str, dataframe: pd.DataFrame, table_config: dict, functions: list) -> tuple:
+    """Transform a single table, returning the dataframe and its report"""
+    start = time.perf_counter()
+    report = {'table': table_name, 'status': 'success', 'rows_in': len(dataframe.index)}
+    dataframe = apply_table_transform(dataframe, table_config, report, functions)
+    report['rows_out'] = len(dataframe.index)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return dataframe, report
+
+
+def apply_transforms(df_dict: dict, config_transform: dict = None) -> tuple:
+    """
+    Apply config-driven transforms to a dictionary of dataframes, running tables concurrently.
+    Tables that fail are logged and left out of the output so the remaining tables can still be loaded.
+    @param df_dict dictionary of dataframes with table name as key
+    With executor process, registered functions are pickled by reference so they must be defined at module level.
+    @param config_transform transform section of config with tables, max_workers and executor (thread or process)
+    @return tuple of transformed dictionary of dataframes and list of per table reports
+    """
+    config_tables = (config_transform or {}).get('tables') or {}
+    todo = {name: config_tables[name] for name in df_dict if config_tables.get(name)}
+    if not todo:
+        return df_dict, []
+
+    df_dict_transformed = {name: df for name, df in df_dict.items() if name not in todo}
+    reports = []
+    executor_cls = ProcessPoolExecutor if config_transform.get('executor') == 'process' else ThreadPoolExecutor
+    with executor_cls(max_workers=config_transform.get('max_workers')) as executor:
+        # functions are resolved here and passed by reference, the registry is only filled in this process
+        futures = {}
+        for name, table_config in todo.items():
+            try:
+                functions = resolve_functions(table_config)
+            except KeyError as e:
+                logging.error(f'Failed to transform {name}, transform function {e} is not registered')
+                reports.append({'table': name, 'status': 'failed', 'error': f'unregistered transform function {e}'})
+                continue
+            futures[executor.submit(_run_table_transform, name, df_dict[name], table_config, functions)] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                df_dict_transformed[name], report = future.result()
+                logging.info(f"Transformed {name}: {report['rows_in']} -> {report['rows_out']} rows in {report['seconds']}s")
+            except Exception as e:
+                logging.exception(f'Failed to transform {name}, skipping table')
+                report = {'table': name, 'status': 'failed', 'error': repr(e)}
+            reports.append(report)
+
+    # keep the original table order
+    df_dict_transformed = {name: df_dict_transformed[name] for name in df_dict if name in df_dict_transformed}
+    return df_dict_transformed, reports
@@ -1,11 +1,14 @@
 import os
+import sys
 import logging
+import argparse
 from datetime import date
 from flask import Flask
 from flask import request, escape
 import google.cloud.logging
 
 from source_a import IngestA
+from ingest.backfill import run_backfill
 from utils import dict_from_yaml
 
 
@@ -19,6 +22,11 @@ logging.basicConfig(
 
 app = Flask(__name__)
 
+# Sources available to the backfill runner: name -> (ingest class, config path)
+SOURCES = {
+    'source_a': (IngestA, 'source_a/config.yaml'),
+}
+
 # Parameters
 @app.route("/source_a", methods=['POST'])
 def ingest_a():
@@ -28,7 +36,8 @@ def ingest_a():
         # request arguments
         json = request.get_json(force=True) # https://stackoverflow.com/questions/53216177/http-triggering-cloud-function-with-cloud-scheduler/60615210#60615210
         increment_type = escape(json['increment_type']) if 'increment_type' in json else 'window'
-        tables = escape(json['tables']) if 'tables' in json else 'all'
+        tables = json['tables'] if 'tables' in json else 'all' # name, comma separated names/patterns or list
+        tables = [escape(x) for x in tables] if isinstance(tables, list) else escape(tables)
         env = escape(json['env']) if 'env' in json else 'prod'
         extract_date = escape(json['extract_date']) if 'extract_date' in json else date.today().strftime("%Y%m%d")
 
@@ -37,6 +46,8 @@ def ingest_a():
             'tables': tables,
             'env': env
         }
+        if 'resume' in json: # false reruns from scratch instead of resuming a failed run from its checkpoint
+            overrides['checkpoint'] = {'resume': str(json['resume']).lower() == 'true'}
 
         config = dict_from_yaml('source_a/config.yaml')
         ingest_a = IngestA(config, extract_date, overrides)
@@ -48,5 +59,64 @@ def ingest_a():
         logging.exception("Failed to ingest ... try again later?")
 
 
+@app.route("/<source>/backfill", methods=['POST'])
+def backfill(source):
+
+    try:
+
+        # request arguments
+        json = request.get_json(force=True)
+        ingest_cls, config_path = SOURCES[source]
+        overrides = {k: escape(json[k]) for k in ('increment_type', 'env') if k in json}
+        if 'tables' in json:
+            overrides['tables'] = [escape(x) for x in json['tables']] if isinstance(json['tables'], list) else escape(json['tables'])
+        if 'resume' in json:
+            overrides['checkpoint'] = {'resume': str(json['resume']).lower() == 'true'}
+
+        config = dict_from_yaml(config_path)
+        summary = run_backfill(ingest_cls, config,
+                               start_date=escape(json['start_date']),
+                               end_date=escape(json['end_date']),
+                               overrides=overrides,
+                               step=escape(json['step']) if 'step' in json else 'DAY',
+                               max_workers=int(json['max_workers']) if 'max_workers' in json else 4,
+                               checkpoint=escape(json['checkpoint']) if 'checkpoint' in json else None)
+        logging.info(f'Backfill finished: {summary}')
+        return summary
+    except Exception as e:
+        logging.exception("Failed to backfill ... try again later?")
+
+
+def cli(argv: list) -> None:
+    """Command line backfill, e.g. python main.py backfill source_a 20240101 20241231 --workers 8"""
+    parser = argparse.ArgumentParser(description='Backfill a source over a date range')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('source', choices=list(SOURCES))
+    parser.add_argument('start_date', help='YYYYMMDD')
+    parser.add_argument('end_date', help='YYYYMMDD, inclusive')
+    parser.add_argument('--step', default='DAY', choices=['DAY', 'MONTH', 'YEAR'])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--checkpoint', help='local path or gs:// uri to record completed dates')
+    parser.add_argument('--tables', help='comma separated table names/patterns')
+    parser.add_argument('--env')
+    parser.add_argument('--run-type', choices=['dev', 'prod'])
+    parser.add_argument('--no-resume', dest='resume', action='store_false', default=None,
+                        help='rerun dates from scratch instead of resuming failed runs from their stage checkpoints')
+    args = parser.parse_args(argv)
+
+    overrides = {k: v for k, v in {'tables': args.tables, 'env': args.env, 'run_type': args.run_type}.items() if v is not None}
+    if args.resume is not None:
+        overrides['checkpoint'] = {'resume': args.resume}
+    ingest_cls, config_path = SOURCES[args.source]
+    summary = run_backfill(ingest_cls, dict_from_yaml(config_path), args.start_date, args.end_date,
+                           overrides=overrides, step=args.step, max_workers=args.workers, checkpoint=args.checkpoint)
+    logging.info(f'Backfill finished: {summary}')
+    if summary['failed']:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+    else:
+        app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
@@ -1,4 +1,5 @@
 from ingest import Ingest
+from . import transform # registers source transforms
 
 ## @TODO for developer: Define child classes of base Ingest class 
 ## and override methods if required. Rename child class to match the source.
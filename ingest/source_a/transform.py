@@ -1,9 +1,13 @@
 import pandas as pd
 
+from ingest import register_transform
 
-def transform_table_a(table_obj: dict) -> pd.DataFrame:
+
+@register_transform
+def transform_table_a(dataframe: pd.DataFrame) -> pd.DataFrame:
     """
-    Function to transform table a from source a
-    @table_obj object containing table specific configuration 
+    Function to transform table a from source a, referenced in config under transform.tables.table_a.functions
+    @param dataframe raw dataframe for table a
+    @return transformed dataframe
     """
-    pass
\ No newline at end of file
+    return dataframe
\ No newline at end of file
@@ -1,23 +1,254 @@
 import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from functools import lru_cache
 import requests
 from jinja2 import Environment, FileSystemLoader
 
 
+DISCORD_MESSAGE_LIMIT = 2000 # discord character restraint per message
+
+
+@lru_cache(maxsize=None)
+def get_template_environment(template_dir: str = 'templates') -> Environment:
+    """
+    Shared jinja2 environment per template directory, so compiled templates are cached across loggers
+    @param template_dir directory containing markdown templates
+    @return jinja2 environment
+    """
+    return Environment(loader=FileSystemLoader(template_dir), auto_reload=False)
+
+
+def split_report(report: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list:
+    """
+    Split a markdown report on '##' headers into chunks with less than limit characters, sections which
+    are too long on their own are split on line breaks (or hard split if a line is too long)
+    @param report rendered markdown report
+    @param limit maximum number of characters per chunk
+    @return list of report chunks
+    """
+    sections = report.split('##')
+    chunks = []
+    current = [sections.pop(0)]
+    current_len = len(current[0])
+    for section in sections:
+        section_len = len(section) + 2
+        if current_len + section_len < limit:
+            current.append(section)
+            current_len += section_len
+        else:
+            chunks.append('##'.join(current))
+            current = ['', section]
+            current_len = section_len
+    chunks.append('##'.join(current))
+
+    final_chunks = []
+    for chunk in chunks:
+        while len(chunk) >= limit:
+            cut = chunk.rfind('\n', 0, limit - 1)
+            if cut <= 0:
+                cut = limit - 1
+            final_chunks.append(chunk[:cut])
+            chunk = chunk[cut:]
+        final_chunks.append(chunk)
+    # a first section over the limit leaves an empty leading chunk, which discord rejects
+    return [x for x in final_chunks if x.strip()]
+
+
 class DiscordLogger:
-    def __init__(self, webhook_url: str) -> None:
+    """
+    Post ingest reports to a discord webhook. By default messages are queued and sent by a background
+    thread which batches small messages together and honours discord rate limits, so a slow webhook
+    never blocks or fails an ingest run.
+    @param webhook_url discord webhook url
+    @param template_dir directory containing markdown templates
+    @param asynchronous if false, post messages in the calling thread
+    @param batch_wait seconds to wait for more messages before sending a batch
+    @param max_retries number of retries for rate limited or failed posts
+    @param timeout request timeout in seconds
+    @param compiled_dir if set, write each sent report chunk to this directory
+    """
+    def __init__(self,
+                 webhook_url: str,
+                 template_dir: str = 'templates',
+                 asynchronous: bool = True,
+                 batch_wait: float = 1.0,
+                 max_retries: int = 5,
+                 timeout: float = 10,
+                 compiled_dir: str = 'compiled',
+                 max_queue_size: int = 1000
+                 ) -> None:
         self.WEBHOOK_URL = webhook_url
-        self.env = Environment(loader=FileSystemLoader('templates'))
+        self.env = get_template_environment(template_dir)
+        self.asynchronous = asynchronous
+        self.batch_wait = batch_wait
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.compiled_dir = compiled_dir
+        self.session = requests.Session()
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._worker = None
+        if asynchronous:
+            self._worker = threading.Thread(target=self.__worker, name='discord-logger', daemon=True)
+            self._worker.start()
+            atexit.register(self.close)
+
+
+    # Delivery
+    def __post(self, content: str) -> bool:
+        """
+        Post content to webhook, retrying after the delay discord asks for when rate limited
+        @param content message content (less than 2000 characters)
+        @return true if message was delivered
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = self.session.post(self.WEBHOOK_URL, {"content": content}, timeout=self.timeout)
+            except requests.RequestException as e:
+                logging.warning(f'Discord post failed ({e}), attempt {attempt + 1}')
+                time.sleep(min(2 ** attempt, 30))
+                continue
+
+            if r.status_code == 429:
+                retry_after = r.headers.get('Retry-After')
+                try:
+                    retry_after = float(retry_after) if retry_after is not None else float(r.json().get('retry_after', 1))
+                except ValueError:
+                    retry_after = 1.0
+                logging.info(f'Discord rate limited, retrying after {retry_after}s')
+                time.sleep(retry_after)
+            elif r.status_code >= 500:
+                time.sleep(min(2 ** attempt, 30))
+            elif r.status_code >= 400:
+                logging.warning(f'Discord rejected message with status {r.status_code}: {r.text}')
+                return False
+            else:
+                return True
+
+        logging.warning(f'Dropping discord message after {self.max_retries} retries')
+        return False
+
+
+    def __worker(self) -> None:
+        """Background loop, batches queued messages up to the discord message limit"""
+        pending = None
+        while True:
+            if pending is None:
+                item = self._queue.get()
+                if item is None:
+                    self._queue.task_done()
+                    return
+                pending = item
+            batch, batch_len, n_items = [pending], len(pending), 1
+            pending = None
+            deadline = time.monotonic() + self.batch_wait
+            stop = False
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                if batch_len + len(item) + 1 < DISCORD_MESSAGE_LIMIT:
+                    batch.append(item)
+                    batch_len += len(item) + 1
+                    n_items += 1
+                else:
+                    pending = item
+                    break
+            try:
+                self.__post('\n'.join(batch))
+            except Exception:
+                logging.exception('Unexpected error posting to discord')
+            finally:
+                for _ in range(n_items):
+                    self._queue.task_done()
+            if stop:
+                self._queue.task_done()
+                return
+
+
+    def send(self, content: str) -> None:
+        """
+        Send a message to discord, queued if asynchronous. Never raises.
+        @param content message content
+        """
+        for chunk in split_report(content):
+            if not self.asynchronous:
+                try:
+                    self.__post(chunk)
+                except Exception:
+                    logging.exception('Unexpected error posting to discord')
+                continue
+            if self._closed:
+                logging.warning('DiscordLogger is closed, dropping message')
+                return
+            try:
+                self._queue.put_nowait(chunk)
+            except queue.Full:
+                logging.warning('Discord queue full, dropping message')
+
+
+    def flush(self, timeout: float = None) -> None:
+        """
+        Wait until queued messages have been sent
+        @param timeout maximum seconds to wait, None waits indefinitely
+        """
+        if not self.asynchronous:
+            return
+        if timeout is None:
+            return self._queue.join()
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
 
+    def close(self, timeout: float = 30) -> None:
+        """
+        Flush queued messages and stop the background worker
+        @param timeout maximum seconds to wait for pending messages
+        """
+        if self._closed or not self.asynchronous:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join(timeout)
 
+
+    def __write_compiled(self, report: str, name: str) -> None:
+        if self.compiled_dir is None:
+            return
+        try:
+            os.makedirs(self.compiled_dir, exist_ok=True)
+            with open(f'{self.compiled_dir}/{name}.md', 'w') as f:
+                f.write(report)
+        except Exception as e:
+            logging.warning(f'Could not write compiled report {name}: {e}')
+
+
+    # Reports
     def render_table_report(self, table_obj: dict, extract_date: str):
         template = self.env.get_template('table-report.md')
         return template.render(extract_date=extract_date, table=table_obj)
 
 
     def log_table_report(self, table_obj: dict, extract_date: str):
-        output_from_parsed_template = self.render_table_report(table_obj, extract_date)
-        return requests.post(self.WEBHOOK_URL, {"content": output_from_parsed_template})
-    
+        try:
+            output_from_parsed_template = self.render_table_report(table_obj, extract_date)
+        except Exception:
+            return logging.exception('Could not render discord table report')
+        return self.send(output_from_parsed_template)
+
 
     def render_source_report(self, table_report_list: str, source_name: str, extract_date: str):
         template = self.env.get_template('source-report.md')
@@ -25,26 +256,12 @@ class DiscordLogger:
 
 
     def log_source_report(self, table_report_list: str, source_name: str, extract_date: str):
-        output_from_parsed_template = self.render_source_report(table_report_list=table_report_list, source_name=source_name, extract_date=extract_date)
+        try:
+            output_from_parsed_template = self.render_source_report(table_report_list=table_report_list, source_name=source_name, extract_date=extract_date)
+        except Exception:
+            return logging.exception(f'Could not render discord source report for {source_name}')
         # splitting into reports with less than 2000 characters (discord character restraint)
-        report_list = output_from_parsed_template.split('##')
-        report_title = report_list.pop(0)
-        final_report_list = [report_title]
-        i=0
-        for report in report_list:
-            if len(f"{final_report_list[i]}##{report}") < 2000:
-                final_report_list[i] = f"{final_report_list[i]}##{report}"
-            else:
-                i=i+1
-                final_report_list.append(f'##{report}')
-
-        for index, report in enumerate(final_report_list):
-            try:
-                with open(f'compiled/{extract_date}-{index}-{source_name}.md', 'w') as f:
-                    f.write(report)
-            except FileNotFoundError:
-                os.mkdir('compiled')
-                with open(f'compiled/{extract_date}-{index}-{source_name}.md', 'w') as f:
-                    f.write(report)
-            finally:
-                requests.post(self.WEBHOOK_URL, {"content": report})
+        final_report_list = split_report(output_from_parsed_template)
+        self.__write_compiled(output_from_parsed_template, f'{extract_date}-{source_name}')
+        for report in final_report_list:
+            self.send(report)
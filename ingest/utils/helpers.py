@@ -1,4 +1,5 @@
 import collections.abc
+from fnmatch import fnmatchcase
 
 
 def update(d, u):
@@ -8,4 +9,29 @@ def update(d, u):
             d[k] = update(d.get(k, {}), v)
         else:
             d[k] = v
-    return d
\ No newline at end of file
+    return d
+
+
+def parse_table_selection(tables) -> list:
+    """
+    Parse table selection from config or request
+    @param tables 'all', None, comma separated string or list of table names/glob patterns (e.g. table_*)
+    @return list of patterns, or None if all tables are selected
+    """
+    if tables is None:
+        return None
+    if isinstance(tables, str):
+        tables = tables.split(',')
+    patterns = [str(x).strip() for x in tables if str(x).strip()]
+    if not patterns or 'all' in patterns:
+        return None
+    return patterns
+
+
+def is_selected(name: str, patterns: list) -> bool:
+    """
+    Check if a table name matches a table selection
+    @param name table name
+    @param patterns list of table names/glob patterns from parse_table_selection, None selects all
+    """
+    return patterns is None or any(fnmatchcase(name, pattern) for pattern in patterns)
\ No newline at end of file